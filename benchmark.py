@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of the exptree functions on synthetic data, e.g.
+python benchmark.py compare --rows 1000 10000 100000 --columns 50
+python benchmark.py newrun --file_size 100000000 --runs 10
+python benchmark.py suite --runs 10000 --keys 30 --output results.json
+python benchmark.py conformance
+'''
+import argparse
+import contextlib
+import io
+import os
+import sys
+import json
+import shutil
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import ruamel.yaml
+from utils import read_notes_yaml, read_notes_row, compare_two_df, compare_two_df_long, get_df_from_folders, get_df_from_csv, write_csv_from_df, write_notes_sidecar, to_ignore_float_error, write_yaml_from_csv, literal_eval_cached, pyarrow
+from newrun import create_new_runs, create_new_run, LINK_MODES
+
+# Types of the values of the synthetic notes.yaml files, see make_value
+VALUE_TYPES = ('float', 'int', 'list', 'string', 'empty')
+# notes.yaml files with the kinds of values whose str() must not depend on the loader, see check_loaders
+LOADER_FIXTURES = ['''id: run1
+empty:
+null_value: null
+tilde: ~
+int: 42
+negative_int: -7
+big_int: 123456789012345678901234567890
+octal: 0o17
+hex: 0x1f
+float: 3.14
+negative_float: -0.5
+exponent: 1e-5
+exponent_sign: 1.0e+3
+trailing_zero: 2.50
+integer_float: 1.0
+inf: .inf
+negative_inf: -.inf
+nan: .nan
+bool: true
+yes: yes
+string: hello world
+quoted: "1.0"
+version: 1.2.3
+date: 2024-01-02
+datetime_t: 2024-01-02T10:00:00
+datetime_lower_t: 2024-01-02t10:00:00
+datetime_space: 2024-01-02 10:00:00
+datetime_utc: 2024-01-02T10:00:00Z
+datetime_offset: 2024-01-02T10:00:00.5+02:00
+datetime_space_offset: 2024-01-02 10:00:00 -5
+datetime_fraction: 2024-01-02T10:00:00.123456789
+datetime_block_list:
+  - 2024-01-02T10:00:00
+  - 2024-01-02 10:00:00+01:00
+flow_list: [1, 2.5, null, abc]
+block_list:
+  - 1
+  - 2.0
+  - ~
+nested_list: [[1, 2], [3.0]]
+mapping: {a: 1, b: 2.0}
+commented: 5  # comment
+''',
+    # Flow collections with timestamps, rejected by the C parser of the fast loader, so read with the round-trip loader
+    'id: run1\ndatetime_flow_list: [2024-01-02T10:00:00Z, 1]\ndatetime_flow_mapping: {start: 2024-01-02T10:00:00Z}\n',
+]
+
+def make_summary_df(n_rows, n_columns, seed=0):
+    '''
+    Create a df like the one returned by get_df_from_csv,
+    with n_rows ids run0, run1, ... and n_columns string columns besides id
+    '''
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 1000, size=(n_rows, n_columns)).astype(str)
+    df = pd.DataFrame(values, columns=[f'key{j}' for j in range(n_columns)])
+    df.insert(0, 'id', [f'run{i}' for i in range(n_rows)])
+    df = df.set_index('id', drop=False)
+    for column in df.columns:
+        df[column] = df[column].astype('string')
+    return df
+
+def change_cells(df, changed_fraction, seed=1):
+    '''
+    Return a copy of df with about changed_fraction of the non-id cells changed
+    '''
+    rng = np.random.default_rng(seed)
+    df = df.copy()
+    for column in df.columns[1:]:
+        changed = rng.random(len(df)) < changed_fraction
+        df.loc[changed, column] = 'changed'
+    return df
+
+def time_call(func, *args, repeat=3, setup=None, **kwargs):
+    '''
+    Return the best wall time in seconds of repeat calls of func
+    setup: if given, called before each call of func, out of the timing
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_compare(args):
+    print(f"{'rows':>8} {'columns':>8} {'changed cells':>14} {'compare_two_df [s]':>19} {'compare_two_df_long [s]':>24}")
+    for n_rows in args.rows:
+        df1 = make_summary_df(n_rows, args.columns)
+        df2 = change_cells(df1, args.changed_fraction)
+        n_changed = len(compare_two_df_long(df1, df2)[2])
+        time_dict = time_call(compare_two_df, df1, df2, repeat=args.repeat)
+        time_long = time_call(compare_two_df_long, df1, df2, repeat=args.repeat)
+        print(f"{n_rows:>8} {args.columns:>8} {n_changed:>14} {time_dict:>19.4f} {time_long:>24.4f}")
+
+def get_used_bytes(path):
+    '''
+    Return the bytes used on the filesystem of path, which also accounts for the data shared by reflinks
+    '''
+    stat = os.statvfs(path)
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+def bench_newrun(args):
+    work_dir = tempfile.mkdtemp(prefix='exptree_benchmark', dir=args.dir)
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        input_dir = os.path.join('template', 'inputs')
+        os.makedirs(input_dir)
+        with open(os.path.join('template', 'notes.yaml'), 'w') as f:
+            f.write('id: template\n')
+        rng = np.random.default_rng(0)
+        for i in range(args.files):
+            with open(os.path.join(input_dir, f'input{i}.dat'), 'wb') as f:
+                f.write(rng.bytes(args.file_size))
+        print(f"Template: {args.files} files of {args.file_size} bytes, {args.runs} runs per mode in {work_dir}")
+        print(f"{'mode':>10} {'time [s]':>10} {'time per run [s]':>17} {'disk used [MB]':>15}")
+        for link_mode in LINK_MODES:
+            os.sync()
+            used_before = get_used_bytes('.')
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_dirs = create_new_runs('template', count=args.runs, jobs=args.jobs, link_mode=link_mode)
+            elapsed = time.perf_counter() - start
+            os.sync()
+            used = get_used_bytes('.') - used_before
+            print(f"{link_mode:>10} {elapsed:>10.4f} {elapsed/args.runs:>17.4f} {used/1e6:>15.1f}")
+            for run_dir in run_dirs:
+                shutil.rmtree(run_dir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+def make_value(value_type, rng):
+    '''
+    Return a random value of value_type (see VALUE_TYPES) as written in notes.yaml
+    '''
+    if value_type == 'float':
+        return repr(float(rng.normal(0, 100)))
+    if value_type == 'int':
+        return str(int(rng.integers(-1000, 1000)))
+    if value_type == 'list':
+        return str([round(float(x), 6) for x in rng.random(int(rng.integers(1, 5)))])
+    if value_type == 'string':
+        return f"text{int(rng.integers(0, 1000000))}"
+    return ''
+
+def make_notes_tree(path, n_runs, n_keys, value_types=VALUE_TYPES, comment_fraction=0.2, seed=0):
+    '''
+    Create a template directory and n_runs run directories in path, each with a notes.yaml of n_keys keys besides id,
+    key j holding values of value_types[j % len(value_types)], and an inline comment on about comment_fraction of the lines
+    '''
+    rng = np.random.default_rng(seed)
+    key_types = [value_types[j % len(value_types)] for j in range(n_keys)]
+    for run_dir in ['template'] + [f'run{i}' for i in range(n_runs)]:
+        lines = [f'id: {run_dir}']
+        for j, value_type in enumerate(key_types):
+            line = f'key{j}: {make_value(value_type, rng)}'.rstrip()
+            if rng.random() < comment_fraction:
+                line += f'  # comment on key{j}'
+            lines.append(line)
+        os.makedirs(os.path.join(path, run_dir))
+        with open(os.path.join(path, run_dir, 'notes.yaml'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+def change_summary_df(df, changed_fraction, seed=1):
+    '''
+    Return a copy of the summary df with one cell changed in about changed_fraction of the rows,
+    floats are changed by a relative 1e-17 (within the float error tolerance) or 1e-3, the other values are replaced
+    '''
+    rng = np.random.default_rng(seed)
+    df = df.copy()
+    columns = [column for column in df.columns if column != 'id']
+    for id in df.index[rng.random(len(df)) < changed_fraction]:
+        column = columns[int(rng.integers(0, len(columns)))]
+        value = df.at[id, column]
+        try:
+            df.at[id, column] = repr(float(value) * (1 + (1e-17 if rng.random() < 0.5 else 1e-3)))
+        except ValueError:
+            df.at[id, column] = f'changed{int(rng.integers(0, 1000))}'
+    return df
+
+def get_git_commit():
+    '''
+    Return the commit of the exptree checkout and whether it has uncommitted changes, None if it is not a git repository
+    '''
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {'commit': commit, 'dirty': dirty}
+
+def bench_suite(args):
+    results = []
+
+    def record(name, items, func, *func_args, repeat=args.repeat, **func_kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            # The values parsed by the previous calls (convert_str_to_objects, to_ignore_float_error) would make the repeats faster
+            seconds = time_call(func, *func_args, repeat=repeat, setup=literal_eval_cached.cache_clear, **func_kwargs)
+        results.append({'name': name, 'seconds': seconds, 'items': items, 'items_per_second': items / seconds if seconds > 0 else None})
+        print(f"{name:<44} {seconds:>10.4f} {items:>9} {results[-1]['items_per_second'] or 0:>12.1f}", flush=True)
+
+    work_dir = tempfile.mkdtemp(prefix='exptree_benchmark', dir=args.dir)
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        make_notes_tree('.', args.runs, args.keys, value_types=args.value_types, comment_fraction=args.comment_fraction, seed=args.seed)
+        n_rows = args.runs + 1
+        print(f"Tree: {args.runs} runs of {args.keys} keys ({', '.join(args.value_types)}), comments on {args.comment_fraction:.0%} of the lines, in {work_dir}")
+        print(f"{'benchmark':<44} {'time [s]':>10} {'items':>9} {'items/s':>12}")
+        record('get_df_from_folders (no cache)', n_rows, get_df_from_folders, use_cache=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Fill notes_cache.json
+            folder_df = get_df_from_folders(use_cache=True, jobs=args.jobs)
+        record('get_df_from_folders (cache)', n_rows, get_df_from_folders, use_cache=True)
+        if args.jobs > 1:
+            record(f'get_df_from_folders (no cache, {args.jobs} jobs)', n_rows, get_df_from_folders, use_cache=False, jobs=args.jobs)
+        record('write_csv_from_df', n_rows, write_csv_from_df, folder_df, backup=False)
+        record('get_df_from_csv', n_rows, get_df_from_csv, use_sidecar=False)
+        record('get_df_from_csv (convert_str_to_objects)', n_rows, get_df_from_csv, use_sidecar=False, convert_str_to_objects=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            write_notes_sidecar(get_df_from_csv(use_sidecar=False))
+        record('get_df_from_csv (sidecar)', n_rows, get_df_from_csv, use_sidecar=True)
+        csv_df = get_df_from_csv(use_sidecar=False)
+        changed_df = change_summary_df(csv_df, args.changed_fraction, seed=args.seed+1)
+        record('compare_two_df', n_rows, compare_two_df, csv_df, changed_df)
+        _, _, changed_value_in_csv_id_column, changed_value_in_changed_id_column = compare_two_df(csv_df, changed_df)
+        n_changed = sum(len(columns) for columns in changed_value_in_csv_id_column.values())
+        record('to_ignore_float_error', n_changed, to_ignore_float_error, changed_value_in_csv_id_column, changed_value_in_changed_id_column)
+        record('write_yaml_from_csv', len(changed_value_in_changed_id_column), write_yaml_from_csv, changed_value_in_changed_id_column, changed_df.columns, jobs=args.jobs, backup='none')
+        record('newrun.create_new_run', 1, create_new_run, 'template')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'benchmark': 'suite',
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'git': get_git_commit(),
+                'versions': {
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'pandas': pd.__version__,
+                    'ruamel.yaml': ruamel.yaml.__version__,
+                    'pyarrow': None if pyarrow is None else pyarrow.__version__,
+                },
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'argv': sys.argv,
+                'parameters': {key: value for key, value in vars(args).items() if key not in ('func', 'benchmark', 'output')},
+                'results': results,
+            }, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+def check_loaders(args):
+    '''
+    Assert that the rows of read_notes_row, read with the fast loader (see get_yaml_loader), have the same str() of every value
+    as the round-trip loader for LOADER_FIXTURES and args.runs random notes.yaml files.
+    collect_notes.py and notes_cache.json use read_notes_row, update_notes.py compares them with the csv and writes with the round-trip loader.
+    '''
+    rng = np.random.default_rng(args.seed)
+    contents = list(LOADER_FIXTURES)
+    for _ in range(args.runs):
+        contents.append('id: run1\n' + ''.join(f'key{j}: {make_value(value_type, rng)}\n' for j, value_type in enumerate(VALUE_TYPES * 4)))
+    differences = []
+    n_values = 0
+    for content in contents:
+        data = read_notes_yaml('run1/notes.yaml', content=content, fast=False)
+        row = read_notes_row('run1/notes.yaml', content=content)
+        assert list(row.keys()) == [str(key) for key in data.keys()], f"The loaders give different keys: {list(data.keys())} and {list(row.keys())}"
+        for key, value in data.items():
+            n_values += 1
+            if str(value) != row[str(key)]:
+                differences.append(f"{key}: {str(value)} with the round-trip loader, {row[str(key)]} in the row")
+    assert len(differences) == 0, f"{len(differences)} of {n_values} values differ between the loaders (ruamel.yaml {ruamel.yaml.__version__}):\n" + "\n".join(differences)
+    print(f"The {n_values} values of {len(contents)} notes.yaml files are the same with both loaders (ruamel.yaml {ruamel.yaml.__version__})")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of exptree on synthetic data')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    parser_compare = subparsers.add_parser('compare', help='Time compare_two_df and compare_two_df_long')
+    parser_compare.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000], help='Numbers of rows to benchmark.')
+    parser_compare.add_argument('--columns', type=int, default=50, help='Number of columns besides id.')
+    parser_compare.add_argument('--changed_fraction', type=float, default=0.01, help='Fraction of the cells changed in the second df.')
+    parser_compare.add_argument('--repeat', type=int, default=3, help='Number of repeats, the best time is reported.')
+    parser_compare.set_defaults(func=bench_compare)
+    parser_newrun = subparsers.add_parser('newrun', help='Time newrun.create_new_runs and measure the disk used in each link mode')
+    parser_newrun.add_argument('--files', type=int, default=4, help='Number of input files in the template.')
+    parser_newrun.add_argument('--file_size', type=int, default=50000000, help='Size of each input file in bytes.')
+    parser_newrun.add_argument('--runs', type=int, default=10, help='Number of runs created in each mode.')
+    parser_newrun.add_argument('--jobs', type=int, default=1, help='Number of threads used to create the runs.')
+    parser_newrun.add_argument('--dir', default='.', help='Directory in which the template and runs are created, its filesystem decides whether reflink is supported.')
+    parser_newrun.set_defaults(func=bench_newrun)
+    parser_suite = subparsers.add_parser('suite', help='Time the main exptree functions end to end on a synthetic tree of run directories')
+    parser_suite.add_argument('--runs', type=int, default=1000, help='Number of run directories.')
+    parser_suite.add_argument('--keys', type=int, default=20, help='Number of keys besides id in each notes.yaml.')
+    parser_suite.add_argument('--value_types', nargs='+', choices=VALUE_TYPES, default=list(VALUE_TYPES), help='Types of the values, assigned to the keys in turn.')
+    parser_suite.add_argument('--comment_fraction', type=float, default=0.2, help='Fraction of the lines of notes.yaml with an inline comment.')
+    parser_suite.add_argument('--changed_fraction', type=float, default=0.1, help='Fraction of the rows with a changed cell, for compare_two_df, to_ignore_float_error and write_yaml_from_csv.')
+    parser_suite.add_argument('--jobs', type=int, default=1, help='Number of processes used to parse and write the notes.yaml files.')
+    parser_suite.add_argument('--repeat', type=int, default=3, help='Number of repeats, the best time is reported.')
+    parser_suite.add_argument('--seed', type=int, default=0, help='Seed of the random values, the same seed gives the same tree.')
+    parser_suite.add_argument('--dir', default=None, help='Directory in which the tree is created, a temporary directory by default.')
+    parser_suite.add_argument('--output', default=None, help='Write the results, the git commit and the versions of the packages to this JSON file.')
+    parser_suite.set_defaults(func=bench_suite)
+    parser_conformance = subparsers.add_parser('conformance', help='Check that the round-trip and fast YAML loaders give the same strings, to run after upgrading ruamel.yaml')
+    parser_conformance.add_argument('--runs', type=int, default=100, help='Number of random notes.yaml files checked besides the fixture.')
+    parser_conformance.add_argument('--seed', type=int, default=0, help='Seed of the random values.')
+    parser_conformance.set_defaults(func=check_loaders)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
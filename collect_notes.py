@@ -1,10 +1,132 @@
 #!/usr/bin/env python3
 import os
+import shutil
+import tempfile
 import pandas as pd
 import argparse
-from utils import get_df_from_folders, get_df_from_csv, create_empty_df, compare_two_df, STRING_YAML_NO_KEY, write_csv_from_df, to_ignore_float_error
+from profiling import add_profile_arguments, start_profiling_from_args, stop_profiling_from_args
+from utils import get_df_from_folders, get_df_from_csv, create_empty_df, compare_two_df, STRING_YAML_NO_KEY, write_csv_from_df, to_ignore_float_error, read_notes_sidecar, write_notes_sidecar, get_notes_dirs, get_ids_from_csv, iter_df_from_csv_slices, write_csv_from_parts, get_summary_file, create_sqlite_index, export_sqlite_to_csv, SUMMARY_BACKENDS, add_selection_arguments, get_selection_from_args, write_csv_rows_from_df, add_preview_arguments, print_ids, print_changes, count_changes_by_column, print_change_counts, append_to_journal, NOTES_JOURNAL_FILE
 
 
+def print_preview_note():
+    print("\n" + "="*80)
+    print("This is a preview mode. No changes have been written to the notes_summary.csv.")
+    print("To apply these changes, run the command with --write flag:")
+    print(f"python {os.path.basename(__file__)} --write")
+    print("="*80)
+
+def print_journal_note(batch):
+    print(f"The changes are recorded as batch {batch} in {NOTES_JOURNAL_FILE}, run python undo_notes.py to revert them.")
+
+def collect_in_chunks(args):
+    '''
+    Collect the notes.yaml files args.chunk_size folders at a time, 
+    diff each chunk against the matching rows of notes_summary.csv, and with --write, 
+    write each merged chunk to a temporary part file which are concatenated to notes_summary.csv at the end.
+    The rows of notes_summary.csv must be in the order of the folders (as written by this script),
+    since they are read sequentially, ids without folders can be anywhere.
+    return False without doing anything if that is not the case
+    '''
+    dirs = get_notes_dirs()
+    dir_chunks = [dirs[i:i+args.chunk_size] for i in range(0, len(dirs), args.chunk_size)]
+    csv_exists = os.path.exists('notes_summary.csv')
+    csv_ids = get_ids_from_csv() if csv_exists else []
+    csv_position = {id: position for position, id in enumerate(csv_ids)}
+    dir_rank = {dir: rank for rank, dir in enumerate(dirs)}
+    ranks = [dir_rank[id] for id in csv_ids if id in dir_rank]
+    if len(csv_position) != len(csv_ids) or any(rank >= next_rank for rank, next_rank in zip(ranks, ranks[1:])):
+        print("The rows of notes_summary.csv are not in the order of the folders or the ids are not unique, collecting all notes in memory instead.")
+        return False
+    print("Found existing notes_summary.csv" if csv_exists else "No existing notes_summary.csv found, will create an empty one")
+    # rows of the csv to read before diffing each chunk of folders
+    stops = []
+    for dir_chunk in dir_chunks:
+        positions = [csv_position[dir] for dir in dir_chunk if dir in csv_position]
+        stops.append(max([stops[-1] if stops else 0] + [position+1 for position in positions]))
+    csv_slices = iter_df_from_csv_slices(stops, args.chunk_size) if csv_exists else iter(create_empty_df() for _ in stops)
+
+    part_dir = tempfile.mkdtemp(prefix='.notes_summary.parts', dir='.') if args.write else None
+    part_files = []
+    extra_part_files = []
+    columns = {} # ordered union of the columns of the folder rows
+    extra_columns = {} # ordered columns of the csv
+    n_new_ids = 0
+    n_extra_ids = 0
+    has_changes_in_all = False
+    # preview of the changes of all the chunks, see print_changes
+    n_printed_ids = 0
+    n_changed_ids = 0
+    change_counts = {}
+    # changes and new ids of all the chunks for the journal
+    journal_csv_id_column = {}
+    journal_folders_id_column = {}
+    journal_new_ids = []
+    try:
+        for i_chunk, dir_chunk in enumerate(dir_chunks):
+            folder_df = get_df_from_folders(use_cache=False, jobs=args.jobs, dirs=dir_chunk)
+            csv_slice = next(csv_slices)
+            is_extra = ~csv_slice.index.isin(folder_df.index)
+            extra_df = csv_slice[is_extra]
+            csv_df = csv_slice[~is_extra]
+            ids_only_in_csv, ids_only_in_folders, changed_value_in_csv_id_column,changed_value_in_folders_id_column=compare_two_df(csv_df,folder_df)
+            if args.write:
+                # The whole chunk is written, including the cells ignored by --ignore_float_error
+                journal_csv_id_column.update(changed_value_in_csv_id_column)
+                journal_folders_id_column.update(changed_value_in_folders_id_column)
+            if args.ignore_float_error:
+                changed_value_in_csv_id_column,changed_value_in_folders_id_column=to_ignore_float_error(changed_value_in_df1_id_column=changed_value_in_csv_id_column,changed_value_in_df2_id_column=changed_value_in_folders_id_column,abs_error=args.abs_error,rel_error=args.rel_error)
+            ids_only_in_folders = [id for id in folder_df.index if id in ids_only_in_folders]
+            if len(ids_only_in_folders) > 0:
+                has_changes_in_all = True
+                journal_new_ids.extend(ids_only_in_folders)
+                if args.preview == 'full' or n_new_ids < args.preview_limit:
+                    print("\nNew entries found, the following ids will be added to the notes_summary.csv:")
+                    print_ids(ids_only_in_folders, preview=args.preview, limit=args.preview_limit-n_new_ids, start=n_new_ids)
+                n_new_ids += len(ids_only_in_folders)
+            if len(changed_value_in_csv_id_column) > 0:
+                has_changes_in_all = True
+                n_changed_ids += len(changed_value_in_csv_id_column)
+                if args.preview == 'summary':
+                    count_changes_by_column(changed_value_in_csv_id_column, changed_value_in_folders_id_column, counts=change_counts)
+                elif args.preview == 'full' or n_printed_ids < args.preview_limit:
+                    print("\nChanges in the existing notes_summary.csv:")
+                    n_printed_ids += print_changes(changed_value_in_csv_id_column, changed_value_in_folders_id_column, preview=args.preview, limit=args.preview_limit-n_printed_ids)
+            n_extra_ids += len(extra_df)
+            columns.update(dict.fromkeys(folder_df.columns))
+            extra_columns.update(dict.fromkeys(csv_slice.columns))
+            if args.write:
+                part_files.append(os.path.join(part_dir, f'part{i_chunk}.csv'))
+                folder_df.to_csv(part_files[-1], index=False)
+                if len(extra_df) > 0:
+                    extra_part_files.append(os.path.join(part_dir, f'extra{len(extra_part_files)}.csv'))
+                    extra_df.to_csv(extra_part_files[-1], index=False)
+        # the csv rows after the last folder found in the csv
+        for extra_df in csv_slices:
+            n_extra_ids += len(extra_df)
+            extra_columns.update(dict.fromkeys(extra_df.columns))
+            if args.write:
+                extra_part_files.append(os.path.join(part_dir, f'extra{len(extra_part_files)}.csv'))
+                extra_df.to_csv(extra_part_files[-1], index=False)
+        if n_new_ids > 0 and args.preview != 'full':
+            print(f"\n{n_new_ids} new ids in total.")
+        if len(change_counts) > 0:
+            print("\nChanges in the existing notes_summary.csv:")
+            print_change_counts(change_counts, n_changed_ids)
+        if n_extra_ids > 0:
+            print(f"\n{n_extra_ids} ids are in the existing notes_summary.csv but their folders are not found. These will be kept as is.")
+            columns.update(extra_columns)
+        if has_changes_in_all:
+            if args.write:
+                write_csv_from_parts(part_files + extra_part_files, list(columns), chunk_size=args.chunk_size)
+                print_journal_note(append_to_journal('csv', journal_csv_id_column, journal_folders_id_column, new_ids=journal_new_ids))
+            else:
+                print_preview_note()
+        else:
+            print("\nNo changes detected.")
+    finally:
+        if part_dir is not None:
+            shutil.rmtree(part_dir)
+    return True
 
 def main():
     # Parse command line arguments
@@ -13,61 +135,111 @@ def main():
     parser.add_argument('--ignore_float_error', action='store_true', help='Ignore float error when comparing information in the notes.yaml files with the notes_summary.csv')
     parser.add_argument('--abs_error', type=float, default=1e-15, help='Absolute error for float comparison.')
     parser.add_argument('--rel_error', type=float, default=1e-15, help='Relative error for float comparison.')
+    parser.add_argument('--no_cache', action='store_true', help='Parse every notes.yaml again instead of reusing the unchanged rows stored in notes_cache.json.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes used to parse the notes.yaml files.')
+    parser.add_argument('--sidecar', action='store_true', help='With --write, also write notes_summary.feather (or notes_summary.npz without pyarrow), which is loaded instead of notes_summary.csv as long as the csv is not edited afterwards.')
+    parser.add_argument('--chunk_size', type=int, default=None, help='Collect the folders this many at a time, diffing each chunk against the matching rows of notes_summary.csv and writing it incrementally, so the memory use does not grow with the number of runs. notes_cache.json is not used in this mode.')
+    parser.add_argument('--backend', choices=SUMMARY_BACKENDS, default='csv', help='Store the summary in notes_summary.csv, or in notes_summary.sqlite, where only the new rows and changed cells are written and rows can be queried with utils.get_df_from_sqlite without loading the whole summary.')
+    parser.add_argument('--sqlite_index', action='append', default=[], metavar='KEY', help='With --backend sqlite, index the numeric values of KEY for queries. Can be given several times.')
+    parser.add_argument('--export_csv', action='store_true', help='With --backend sqlite, also write notes_summary.csv from notes_summary.sqlite, so it can be edited by hand and used by update_notes.py.')
+    add_preview_arguments(parser)
+    add_selection_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    selection = get_selection_from_args(args)
+    if args.chunk_size is not None and args.chunk_size < 1:
+        parser.error('--chunk_size must be at least 1')
+    if args.chunk_size is not None and selection is not None:
+        parser.error('--ids, --match, --since and --templates cannot be used with --chunk_size')
+    if args.chunk_size is not None and args.sidecar:
+        parser.error('--sidecar cannot be used with --chunk_size')
+    if args.backend == 'sqlite' and (args.chunk_size is not None or args.sidecar):
+        parser.error('--chunk_size and --sidecar cannot be used with --backend sqlite')
+    if args.backend != 'sqlite' and (args.sqlite_index or args.export_csv):
+        parser.error('--sqlite_index and --export_csv need --backend sqlite')
+
+    start_profiling_from_args(args)
+    try:
+        collect(args, selection)
+    finally:
+        stop_profiling_from_args(args)
+
+def collect(args, selection):
+    '''
+    Collect the notes.yaml files selected by selection (see get_notes_dirs) into the summary, as described by the arguments of main
+    '''
+    if args.chunk_size is not None and collect_in_chunks(args):
+        return
 
     has_changes_in_all = False
     
     # Get new data from yaml files
-    folder_df = get_df_from_folders()
+    folder_df = get_df_from_folders(use_cache=not args.no_cache, jobs=args.jobs, selection=selection)
 
     # Load existing data if available
-    if os.path.exists('notes_summary.csv'):
-        csv_df = get_df_from_csv()
-        print("Found existing notes_summary.csv")
+    summary_file = get_summary_file(args.backend)
+    if os.path.exists(summary_file):
+        csv_df = get_df_from_csv(backend=args.backend)
+        print(f"Found existing {summary_file}")
     else:
         #save an empty dataframe
         csv_df = create_empty_df()
-        print("No existing notes_summary.csv found, will create an empty one")
+        print(f"No existing {summary_file} found, will create an empty one")
+    if selection is not None:
+        # Only the rows of the selected folders are compared and written
+        is_selected = csv_df.index.isin(folder_df.index)
+        print(f"{len(folder_df)} folders selected, the other {(~is_selected).sum()} rows of {summary_file} are kept as is")
+        csv_df = csv_df[is_selected]
     
     # Find new entries
     ids_only_in_csv, ids_only_in_folders, changed_value_in_csv_id_column,changed_value_in_folders_id_column=compare_two_df(csv_df,folder_df)
+    # All the changes, including the ones ignored by --ignore_float_error, which are written as well in the rows that are written
+    all_changed_value_in_csv_id_column, all_changed_value_in_folders_id_column = changed_value_in_csv_id_column, changed_value_in_folders_id_column
     if args.ignore_float_error:
         changed_value_in_csv_id_column,changed_value_in_folders_id_column=to_ignore_float_error(changed_value_in_df1_id_column=changed_value_in_csv_id_column,changed_value_in_df2_id_column=changed_value_in_folders_id_column,abs_error=args.abs_error,rel_error=args.rel_error)
 
     if len(ids_only_in_csv) > 0:
         print(f"The following ids are in the existing notes_summary.csv but their folders are not found. These will be kept as is:")
-        extra_df=csv_df[list(ids_only_in_csv)]
+        extra_df=csv_df[csv_df.index.isin(ids_only_in_csv)]
+        print_ids(extra_df.index, preview=args.preview, limit=args.preview_limit)
         new_df=pd.concat([folder_df,extra_df])
     else:
         new_df=folder_df    
     if len(ids_only_in_folders) > 0:
         has_changes_in_all = True
         print("\nNew entries found, the following ids will be added to the notes_summary.csv:")
-        for i, id in enumerate(ids_only_in_folders):
-            print(f"{i+1}: {id}")
+        print_ids(ids_only_in_folders, preview=args.preview, limit=args.preview_limit)
     
     if len(changed_value_in_csv_id_column) > 0:
         has_changes_in_all = True
         print("\nChanges in the existing notes_summary.csv:")
-        for id in changed_value_in_csv_id_column.keys():
-            changed_value_in_csv_column = changed_value_in_csv_id_column[id]
-            changed_value_in_folder_column = changed_value_in_folders_id_column[id]
-            print(f"\nChanges in {id}:")
-            for col in changed_value_in_csv_column.keys():
-                print(f"  {col}: {changed_value_in_csv_column[col]} -> {changed_value_in_folder_column[col]}")
+        print_changes(changed_value_in_csv_id_column, changed_value_in_folders_id_column, preview=args.preview, limit=args.preview_limit)
                 
     # Handle changes based on --write flag
     if has_changes_in_all:
         if args.write:
-            write_csv_from_df(new_df)
+            if selection is not None and args.backend == 'csv':
+                changed_ids = list(ids_only_in_folders) + list(changed_value_in_folders_id_column.keys())
+                write_csv_rows_from_df(new_df[new_df.index.isin(changed_ids)], sidecar=args.sidecar)
+                written_ids = set(changed_value_in_folders_id_column)
+                all_changed_value_in_csv_id_column = {id: value for id, value in all_changed_value_in_csv_id_column.items() if id in written_ids}
+            else:
+                write_csv_from_df(new_df, sidecar=args.sidecar, backend=args.backend, changed_value_id_column=changed_value_in_folders_id_column)
+            if args.backend == 'sqlite':
+                # Only the changes which are not ignored are written to the database
+                all_changed_value_in_csv_id_column, all_changed_value_in_folders_id_column = changed_value_in_csv_id_column, changed_value_in_folders_id_column
+            print_journal_note(append_to_journal(args.backend, all_changed_value_in_csv_id_column, all_changed_value_in_folders_id_column, new_ids=ids_only_in_folders))
         else:
-            print("\n" + "="*80)
-            print("This is a preview mode. No changes have been written to the notes_summary.csv.")
-            print("To apply these changes, run the command with --write flag:")
-            print(f"python {os.path.basename(__file__)} --write")
-            print("="*80)
+            print_preview_note()
     else:
         print("\nNo changes detected.")
+        if args.write and args.sidecar and os.path.exists('notes_summary.csv') and read_notes_sidecar() is None:
+            write_notes_sidecar(get_df_from_csv(use_sidecar=False))
+    if args.write and args.backend == 'sqlite' and os.path.exists(summary_file):
+        for key in args.sqlite_index:
+            create_sqlite_index(key)
+        if args.export_csv:
+            export_sqlite_to_csv()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -2,50 +2,229 @@
 import os
 import shutil
 import re
+import time
+import errno
+import uuid
 import argparse
+from fnmatch import fnmatch
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from ruamel.yaml import YAML
+from profiling import profile_stage, add_profile_arguments, start_profiling_from_args, stop_profiling_from_args
+
+# Next run index to try, shared by all invocations of newrun.py in the current directory
+RUN_INDEX_FILE = '.run_index'
+RUN_INDEX_LOCK = '.run_index.lock'
+# Globs of the files of a template, relative to it, that are modified in the runs and always copied, one per line
+MUTABLE_FILES_MANIFEST = '.exptree_mutable'
+# How the files of a template which are not mutable are put in the runs, see fill_run_dir
+LINK_MODES = ('copy', 'reflink', 'hardlink', 'symlink')
+# ioctl request of Linux to share the data of a file with another one on copy-on-write filesystems (Btrfs, XFS, ...)
+FICLONE = 0x40049409
 
 def get_max_run_index():
     """Find the maximum run index in the current directory"""
     max_index = -1
-    for item in os.listdir('.'):
-        if os.path.isdir(item):
-            match = re.match(r'run(\d+)', item)
-            if match:
-                index = int(match.group(1))
-                max_index = max(max_index, index)
+    with os.scandir('.') as entries:
+        for entry in entries:
+            match = re.match(r'run(\d+)', entry.name)
+            if match and entry.is_dir():
+                max_index = max(max_index, int(match.group(1)))
     return max_index
 
-def create_new_run(template_dir):
-    """Create a new run directory by copying the template directory"""
+def remove_lock_if_held_by(token):
+    """
+    Remove RUN_INDEX_LOCK if it holds token, return whether it did.
+    The lock is first renamed to a unique name, so that only one process can remove it, and put back if it holds another token
+    """
+    moved_file = f'{RUN_INDEX_LOCK}.{uuid.uuid4().hex}'
+    try:
+        os.rename(RUN_INDEX_LOCK, moved_file)
+    except FileNotFoundError:
+        return False
+    try:
+        with open(moved_file, 'r') as f:
+            is_held = f.read() == token
+        if not is_held:
+            try:
+                os.link(moved_file, RUN_INDEX_LOCK)
+            except FileExistsError:
+                pass
+        return is_held
+    finally:
+        os.remove(moved_file)
+
+@contextmanager
+def run_index_lock(timeout=60):
+    """
+    Hold the lock file protecting RUN_INDEX_FILE, which holds the pid of its owner and a random token.
+    A lock file older than timeout seconds is considered stale and removed, unless it was replaced in the meantime
+    """
+    token = f'{os.getpid()}-{uuid.uuid4().hex}'
+    while True:
+        try:
+            fd = os.open(RUN_INDEX_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                with open(RUN_INDEX_LOCK, 'r') as f:
+                    holder = f.read()
+                is_stale = time.time() - os.path.getmtime(RUN_INDEX_LOCK) > timeout
+            except FileNotFoundError:
+                continue
+            if is_stale:
+                remove_lock_if_held_by(holder)
+                continue
+            time.sleep(0.05)
+    try:
+        os.write(fd, token.encode())
+        os.close(fd)
+        yield
+    finally:
+        # The lock is not ours anymore if another process found it stale
+        remove_lock_if_held_by(token)
+
+def reserve_run_dirs(count):
+    """
+    Create count empty run directories with new indices and return their names.
+    Each directory is created with os.mkdir, which fails if it already exists, so concurrent invocations never get the same one.
+    The next index is kept in RUN_INDEX_FILE, so the directory is not listed each time,
+    and indices of deleted runs are not reused.
+    """
+    with run_index_lock():
+        try:
+            with open(RUN_INDEX_FILE, 'r') as f:
+                next_index = int(f.read())
+        except (FileNotFoundError, ValueError):
+            next_index = get_max_run_index() + 1
+        new_run_dirs = []
+        while len(new_run_dirs) < count:
+            try:
+                os.mkdir(f'run{next_index}')
+                new_run_dirs.append(f'run{next_index}')
+            except FileExistsError:
+                pass
+            next_index += 1
+        tmp_file = f'{RUN_INDEX_FILE}.tmp{os.getpid()}'
+        with open(tmp_file, 'w') as f:
+            f.write(str(next_index))
+        os.replace(tmp_file, RUN_INDEX_FILE)
+    return new_run_dirs
+
+def read_mutable_globs(template_dir):
+    """Read the globs in MUTABLE_FILES_MANIFEST of the template directory, ignoring blank lines and lines starting with #"""
+    manifest_path = os.path.join(template_dir, MUTABLE_FILES_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, 'r') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+def reflink_file(src, dst):
+    """Create dst sharing the data of src with the FICLONE ioctl, raise OSError if the filesystem does not support it"""
+    import fcntl
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    shutil.copystat(src, dst)
+
+def link_file(src, dst, link_mode):
+    """
+    Put src at dst according to link_mode (see LINK_MODES),
+    falling back to a copy when the filesystem cannot reflink or hardlink the file
+    """
+    try:
+        if link_mode == 'reflink':
+            reflink_file(src, dst)
+        elif link_mode == 'hardlink':
+            os.link(src, dst)
+        elif link_mode == 'symlink':
+            os.symlink(os.path.relpath(os.path.abspath(src), os.path.dirname(os.path.abspath(dst))), dst)
+        else:
+            shutil.copy2(src, dst)
+    except (OSError, ImportError) as e:
+        if link_mode == 'symlink' or (isinstance(e, OSError) and e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOSYS)):
+            raise
+        if os.path.exists(dst):
+            os.remove(dst)
+        shutil.copy2(src, dst)
+    return dst
+
+def fill_run_dir(template_dir, new_run_dir, link_mode='copy', link_threshold=0):
+    """
+    Copy the template directory into the reserved run directory and update the id in notes.yaml
+    link_mode: with 'reflink', 'hardlink' or 'symlink', the files of the template of at least link_threshold bytes
+    are reflinked, hardlinked or symlinked instead of copied, except notes.yaml and the files matching MUTABLE_FILES_MANIFEST.
+    Hardlinked and symlinked files share their content with the template, they must not be modified in the runs.
+    """
+    assert link_mode in LINK_MODES, f"Unknown link mode {link_mode}"
+    mutable_globs = read_mutable_globs(template_dir)
+
+    def copy_function(src, dst):
+        relative_path = os.path.relpath(src, template_dir)
+        if link_mode == 'copy' or relative_path == 'notes.yaml' or any(fnmatch(relative_path, pattern) for pattern in mutable_globs) or os.path.getsize(src) < link_threshold:
+            return shutil.copy2(src, dst)
+        return link_file(src, dst, link_mode)
+
+    # Copy with symlinks=True to preserve symbolic links
+    shutil.copytree(template_dir, new_run_dir, symlinks=True, dirs_exist_ok=True, copy_function=copy_function)
+    # Update notes.yaml
+    notes_path = os.path.join(new_run_dir, 'notes.yaml')
+    if os.path.exists(notes_path):
+        yaml = YAML()
+        yaml.preserve_quotes = True
+        with open(notes_path, 'r') as f:
+            notes = yaml.load(f)
+        notes['id'] = new_run_dir
+        with open(notes_path, 'w') as f:
+            yaml.dump(notes, f)
+
+def create_new_runs(template_dir, count=1, jobs=1, link_mode='copy', link_threshold=0):
+    """
+    Create count new run directories by copying the template directory, with jobs threads, return the created ones
+    link_mode and link_threshold select which files are linked instead of copied, see fill_run_dir
+    """
     if not os.path.exists(template_dir):
         print(f"Error: Template directory '{template_dir}' does not exist!")
-        return
-    
-    max_index = get_max_run_index()
-    new_index = max_index + 1
-    new_run_dir = f'run{new_index}'
-    
-    try:
-        # Copy with symlinks=True to preserve symbolic links
-        shutil.copytree(template_dir, new_run_dir, symlinks=True)
-        # Update notes.yaml
-        notes_path = os.path.join(new_run_dir, 'notes.yaml')
-        if os.path.exists(notes_path):
-            yaml = YAML()
-            yaml.preserve_quotes = True
-            with open(notes_path, 'r') as f:
-                notes = yaml.load(f)
-            notes['id'] = new_run_dir
-            with open(notes_path, 'w') as f:
-                yaml.dump(notes, f)
-        print(f"Successfully created new run directory: {new_run_dir}")
-    except Exception as e:
-        print(f"Error creating new run directory: {str(e)}")
+        return []
+
+    with profile_stage('reserve run directories', count):
+        new_run_dirs = reserve_run_dirs(count)
+
+    def create(new_run_dir):
+        try:
+            fill_run_dir(template_dir, new_run_dir, link_mode=link_mode, link_threshold=link_threshold)
+            return None
+        except Exception as e:
+            return str(e)
+
+    with profile_stage('copy template', len(new_run_dirs)):
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            errors = list(executor.map(create, new_run_dirs))
+    created_run_dirs = []
+    for new_run_dir, error in zip(new_run_dirs, errors):
+        if error is None:
+            created_run_dirs.append(new_run_dir)
+            print(f"Successfully created new run directory: {new_run_dir}")
+        else:
+            print(f"Error creating new run directory {new_run_dir}: {error}")
+    return created_run_dirs
+
+def create_new_run(template_dir, link_mode='copy', link_threshold=0):
+    """Create a new run directory by copying the template directory, return its name or None if it fails"""
+    created_run_dirs = create_new_runs(template_dir, count=1, link_mode=link_mode, link_threshold=link_threshold)
+    return created_run_dirs[0] if created_run_dirs else None
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Create a new run directory by copying a template directory')
     parser.add_argument('template_dir', help='Path to the template directory to copy')
+    parser.add_argument('--count', type=int, default=1, help='Number of run directories to create.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of threads used to copy the template directory.')
+    parser.add_argument('--link_mode', choices=LINK_MODES, default='copy', help=f'How the files of the template are put in the runs, except notes.yaml and the files matching the globs in {MUTABLE_FILES_MANIFEST} of the template, which are always copied. reflink shares the data until it is modified (copy-on-write filesystems only, copies otherwise), hardlink and symlink share the files with the template, which must then not be modified.')
+    parser.add_argument('--link_threshold', type=int, default=0, help='Only files of at least this many bytes are linked according to --link_mode, smaller ones are copied.')
+    add_profile_arguments(parser)
     args = parser.parse_args()
-    
-    create_new_run(args.template_dir) 
\ No newline at end of file
+
+    start_profiling_from_args(args)
+    try:
+        create_new_runs(args.template_dir, count=args.count, jobs=args.jobs, link_mode=args.link_mode, link_threshold=args.link_threshold)
+    finally:
+        stop_profiling_from_args(args)
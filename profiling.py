@@ -0,0 +1,135 @@
+'''
+Timing of the stages of the exptree scripts, enabled with --profile, e.g.
+python collect_notes.py --profile --profile_json profile.json
+The functions of utils.py time their stages with profile_stage, which does nothing unless start_profiling was called.
+'''
+import os
+import sys
+import json
+import time
+import platform
+import cProfile
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak RSS is then not reported
+    resource = None
+
+# name: {'calls', 'seconds', 'items'} of the stages, in the order they first ran, None when profiling is off
+_stages = None
+_active_stages = set()
+_start_time = None
+_cprofile = None
+
+def start_profiling(cprofile=False):
+    '''
+    Start recording the stages run with profile_stage in this process
+    cprofile: also run cProfile, whose statistics are written by stop_profiling
+    '''
+    global _stages, _start_time, _cprofile
+    _stages = {}
+    _start_time = time.perf_counter()
+    if cprofile:
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+
+def is_profiling():
+    return _stages is not None
+
+def get_peak_rss_mb():
+    '''
+    Get the peak resident memory in MB of this process, and the largest peak of its finished child processes (e.g. the workers of --jobs),
+    None for both if it cannot be measured. They are not added up since the two peaks are not reached at the same time
+    '''
+    if resource is None:
+        return None, None
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1e6, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1e6
+
+@contextmanager
+def profile_stage(name, items=None):
+    '''
+    Time the code in the with block as the stage name, adding up the calls with the same name
+    items: number of items (files, rows, cells, ...) processed, to report the items per second
+    '''
+    if _stages is None or name in _active_stages:
+        # Stages calling each other (e.g. the writers of the summary) are only counted once
+        yield
+        return
+    _active_stages.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _active_stages.discard(name)
+        stage = _stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'items': None})
+        stage['calls'] += 1
+        stage['seconds'] += time.perf_counter() - start
+        if items is not None:
+            stage['items'] = (stage['items'] or 0) + items
+        stage['peak_rss_mb'], stage['children_peak_rss_mb'] = get_peak_rss_mb()
+
+def stop_profiling(json_file=None, cprofile_file=None):
+    '''
+    Stop profiling, print the table of the stages,
+    write them to json_file and the cProfile statistics to cprofile_file (read with python -m pstats) if given
+    '''
+    global _stages, _cprofile
+    if _stages is None:
+        return
+    if _cprofile is not None:
+        _cprofile.disable()
+        if cprofile_file is not None:
+            _cprofile.dump_stats(cprofile_file)
+    total_seconds = time.perf_counter() - _start_time
+    peak_rss_mb, children_peak_rss_mb = get_peak_rss_mb()
+    stages = [{'stage': name, **stage, 'items_per_second': stage['items'] / stage['seconds'] if stage['items'] is not None and stage['seconds'] > 0 else None}
+              for name, stage in _stages.items()]
+    print_profile(stages, total_seconds)
+    if json_file is not None:
+        with open(json_file, 'w') as f:
+            json.dump({
+                'argv': sys.argv,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'total_seconds': total_seconds,
+                'peak_rss_mb': peak_rss_mb,
+                'children_peak_rss_mb': children_peak_rss_mb,
+                'stages': stages,
+            }, f, indent=2)
+        print(f"Profile saved to {json_file}")
+    if cprofile_file is not None and _cprofile is not None:
+        print(f"cProfile statistics saved to {cprofile_file}, see python -m pstats {cprofile_file}")
+    _stages = None
+    _cprofile = None
+
+def print_profile(stages, total_seconds):
+    print("\n" + "="*80)
+    print(f"{'stage':<28} {'calls':>6} {'time [s]':>10} {'%':>6} {'items':>9} {'items/s':>11} {'peak RSS [MB]':>14} {'workers peak [MB]':>17}")
+    for stage in stages:
+        items = '' if stage['items'] is None else f"{stage['items']}"
+        items_per_second = '' if stage['items_per_second'] is None else f"{stage['items_per_second']:.1f}"
+        peak_rss = '' if stage['peak_rss_mb'] is None else f"{stage['peak_rss_mb']:.1f}"
+        children_peak_rss = '' if stage['children_peak_rss_mb'] is None else f"{stage['children_peak_rss_mb']:.1f}"
+        print(f"{stage['stage']:<28} {stage['calls']:>6} {stage['seconds']:>10.4f} {100*stage['seconds']/total_seconds:>6.1f} {items:>9} {items_per_second:>11} {peak_rss:>14} {children_peak_rss:>17}")
+    print(f"{'total':<28} {'':>6} {total_seconds:>10.4f} {100.0:>6.1f}")
+    print("="*80)
+
+def add_profile_arguments(parser):
+    '''
+    Add the --profile, --profile_json and --profile_cprofile arguments to the parser, see start_profiling_from_args
+    '''
+    parser.add_argument('--profile', action='store_true', help='Print the wall time, items per second and peak memory of each stage at the end.')
+    parser.add_argument('--profile_json', default=None, metavar='FILE', help='Also write the profile to this JSON file, implies --profile.')
+    parser.add_argument('--profile_cprofile', default=None, metavar='FILE', help='Also run cProfile and write its statistics to this file, implies --profile.')
+
+def start_profiling_from_args(args):
+    if args.profile or args.profile_json is not None or args.profile_cprofile is not None:
+        start_profiling(cprofile=args.profile_cprofile is not None)
+
+def stop_profiling_from_args(args):
+    stop_profiling(json_file=args.profile_json, cprofile_file=args.profile_cprofile)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import os
+import argparse
+from utils import get_df_from_folders, get_df_from_csv, write_csv_from_df, write_yaml_from_csv, read_journal, append_to_journal, add_preview_arguments, print_ids, print_changes, get_summary_file, STRING_YAML_NO_KEY, NOTES_JOURNAL_FILE
+
+# Prefix of the batches of the journal written by this script, followed by the reverted batch
+UNDO_BATCH_PREFIX = 'undo:'
+
+def get_batches(records):
+    '''
+    Group the records of the journal by batch, in the order of the journal
+    '''
+    batches = {}
+    for record in records:
+        batches.setdefault(record['batch'], []).append(record)
+    return batches
+
+def get_batch_to_undo(batches, batch=None):
+    '''
+    Return the batch to revert: batch if given, otherwise the last batch which is not an undo and has not been reverted yet,
+    None if there is none
+    '''
+    undone = {name[len(UNDO_BATCH_PREFIX):] for name in batches if name.startswith(UNDO_BATCH_PREFIX)}
+    if batch is not None:
+        assert batch in batches, f"The batch {batch} is not in {NOTES_JOURNAL_FILE}"
+        assert batch not in undone, f"The batch {batch} has already been reverted"
+        return batch
+    candidates = [name for name in batches if not name.startswith(UNDO_BATCH_PREFIX) and name not in undone]
+    return candidates[-1] if candidates else None
+
+def print_batches(batches):
+    undone = {name[len(UNDO_BATCH_PREFIX):] for name in batches if name.startswith(UNDO_BATCH_PREFIX)}
+    print(f"{'batch':<40} {'time':<20} {'target':<7} {'cells':>8} {'added':>6} {'removed':>8}")
+    for name, records in batches.items():
+        ops = [record['op'] for record in records]
+        note = ' (reverted)' if name in undone else ''
+        print(f"{name:<40} {records[0]['time']:<20} {records[0]['target']:<7} {ops.count('change'):>8} {ops.count('add'):>6} {ops.count('remove'):>8}{note}")
+
+def get_reverted_changes(records, get_current_value, force=False):
+    '''
+    Get the changes reverting the 'change' records: current value and old value as id: column: value dictionaries,
+    the cells whose current value (given by get_current_value(id, column)) is not the new value of the record anymore are left out and printed,
+    unless force is True
+    '''
+    changed_value_current_id_column = {}
+    changed_value_old_id_column = {}
+    conflicts = []
+    for record in records:
+        if record['op'] != 'change':
+            continue
+        id, column = record['id'], record['column']
+        current = get_current_value(id, column)
+        if current != record['new'] and not force:
+            conflicts.append(f"{id} {column}: {current} (expected {record['new']})")
+            continue
+        if current != record['old']:
+            changed_value_current_id_column.setdefault(id, {})[column] = current
+            changed_value_old_id_column.setdefault(id, {})[column] = record['old']
+    if len(conflicts) > 0:
+        print(f"\nThe following {len(conflicts)} cells have been changed since the batch and are not reverted, use --force to revert them anyway:")
+        print_ids(conflicts)
+    return changed_value_current_id_column, changed_value_old_id_column
+
+def undo_yaml(batch, records, args):
+    '''
+    Revert the changes of the batch in the notes.yaml files
+    '''
+    ids = list(dict.fromkeys(record['id'] for record in records if os.path.exists(os.path.join(record['id'], 'notes.yaml'))))
+    folder_df = get_df_from_folders(use_cache=not args.no_cache, jobs=args.jobs, dirs=ids)
+
+    def get_current_value(id, column):
+        if id in folder_df.index and column in folder_df.columns:
+            return folder_df.at[id, column]
+        return STRING_YAML_NO_KEY
+
+    changed_value_current_id_column, changed_value_old_id_column = get_reverted_changes(records, get_current_value, force=args.force)
+    if len(changed_value_old_id_column) == 0:
+        print("\nNo changes to revert.")
+        return
+    print("\nChanges in notes.yaml in each folder:")
+    print_changes(changed_value_current_id_column, changed_value_old_id_column, preview=args.preview, limit=args.preview_limit, title='Changes in ./{id}/notes.yaml:')
+    if args.write:
+        # Keep the order of the keys of each file
+        write_yaml_from_csv(changed_value_old_id_column, [], jobs=args.jobs, backup=args.backup, journal_old_id_column=changed_value_current_id_column, journal_batch=UNDO_BATCH_PREFIX+batch)
+        print(f"Reverted batch {batch}.")
+    else:
+        print_preview_note()
+
+def undo_summary(batch, records, target, args):
+    '''
+    Revert the changes of the batch in the summary stored in target (see SUMMARY_BACKENDS): the changed cells get their old value back,
+    the added rows are removed, and the columns added by the batch are removed if they are left without any value
+    '''
+    summary_file = get_summary_file(target)
+    assert os.path.exists(summary_file), f"{summary_file} not found"
+    df = get_df_from_csv(use_sidecar=False, backend=target)
+
+    def get_current_value(id, column):
+        if id in df.index and column in df.columns:
+            return df.at[id, column]
+        return STRING_YAML_NO_KEY
+
+    changed_value_current_id_column, changed_value_old_id_column = get_reverted_changes(records, get_current_value, force=args.force)
+    added_ids = [record['id'] for record in records if record['op'] == 'add' and record['id'] in df.index]
+    if len(changed_value_old_id_column) == 0 and len(added_ids) == 0:
+        print("\nNo changes to revert.")
+        return
+    if len(added_ids) > 0:
+        print(f"\nThe following ids were added by the batch and will be removed from {summary_file}:")
+        print_ids(added_ids, preview=args.preview, limit=args.preview_limit)
+    if len(changed_value_old_id_column) > 0:
+        print(f"\nChanges in the existing {summary_file}:")
+        print_changes(changed_value_current_id_column, changed_value_old_id_column, preview=args.preview, limit=args.preview_limit)
+    if args.write:
+        for id, changed_value_old_column in changed_value_old_id_column.items():
+            for column, value in changed_value_old_column.items():
+                if column not in df.columns:
+                    df[column] = STRING_YAML_NO_KEY
+                df.at[id, column] = value
+        df = df[~df.index.isin(added_ids)]
+        batch_columns = {record['column'] for record in records if record['op'] == 'change'}
+        df = df.drop(columns=[column for column in df.columns if column in batch_columns and column != 'id' and (df[column] == STRING_YAML_NO_KEY).all()])
+        write_csv_from_df(df, backend=target)
+        append_to_journal(target, changed_value_current_id_column, changed_value_old_id_column, removed_ids=added_ids, batch=UNDO_BATCH_PREFIX+batch)
+        print(f"Reverted batch {batch}.")
+    else:
+        print_preview_note()
+
+def print_preview_note():
+    print("\n" + "="*80)
+    print("This is a preview mode. No changes have been reverted.")
+    print("To apply these changes, run the command with --write flag:")
+    print(f"python {os.path.basename(__file__)} --write")
+    print("="*80)
+
+def main():
+    parser = argparse.ArgumentParser(description=f'Revert the changes written by collect_notes.py, update_notes.py, watch_notes.py or modify_yamls_by_func, as recorded in {NOTES_JOURNAL_FILE}')
+    parser.add_argument('--write', action='store_true', help='Revert the changes (default: preview only).')
+    parser.add_argument('--batch', default=None, help='Batch of the journal to revert (default: the last one which has not been reverted yet).')
+    parser.add_argument('--list', action='store_true', help='List the batches of the journal and exit.')
+    parser.add_argument('--force', action='store_true', help='Also revert the cells which have been changed again since the batch.')
+    parser.add_argument('--no_cache', action='store_true', help='Parse every notes.yaml again instead of reusing the unchanged rows stored in notes_cache.json.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes used to parse and write the notes.yaml files.')
+    parser.add_argument('--backup', choices=['file', 'archive', 'none'], default='file', help='Backup of the notes.yaml files to write, see update_notes.py.')
+    add_preview_arguments(parser)
+    args = parser.parse_args()
+
+    batches = get_batches(read_journal())
+    if args.list:
+        print_batches(batches)
+        return
+    batch = get_batch_to_undo(batches, args.batch)
+    if batch is None:
+        print(f"No batch to revert in {NOTES_JOURNAL_FILE}")
+        return
+    records = batches[batch]
+    target = records[0]['target']
+    print(f"Reverting batch {batch} of {records[0]['time']} ({target})")
+    if target == 'yaml':
+        undo_yaml(batch, records, args)
+    else:
+        undo_summary(batch, records, target, args)
+
+if __name__ == "__main__":
+    main()
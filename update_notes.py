@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import os
 import argparse
-from utils import get_df_from_folders, get_df_from_csv, compare_two_df, STRING_YAML_EMPTY, STRING_YAML_NO_KEY, write_yaml_from_csv
+from profiling import add_profile_arguments, start_profiling_from_args, stop_profiling_from_args
+from utils import get_df_from_folders, get_df_from_csv, compare_two_df, STRING_YAML_EMPTY, STRING_YAML_NO_KEY, write_yaml_from_csv, get_summary_file, SUMMARY_BACKENDS, add_selection_arguments, get_selection_from_args, add_preview_arguments, print_ids, print_changes, new_journal_batch, NOTES_JOURNAL_FILE
 
 
 
@@ -9,48 +10,65 @@ def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Update yaml files from notes_summary.csv')
     parser.add_argument('--write', action='store_true', help=f'Write changes to files (default: preview only). Ignore the extra ids in extra ids either in notes_summary.csv or in the folders. Namely no creation or deletion of yaml files will be performed. For the yaml files to modify, its key sequence will be sorted to follow the order of columns in notes_summary.csv. {STRING_YAML_EMPTY} in csv will be converted to None in yaml, while keys with value {STRING_YAML_NO_KEY} in csv will be deleted in yaml. All blank values in csv is assumed as {STRING_YAML_NO_KEY} when loading the csv.')
+    parser.add_argument('--no_cache', action='store_true', help='Parse every notes.yaml again instead of reusing the unchanged rows stored in notes_cache.json.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes used to parse and write the notes.yaml files.')
+    parser.add_argument('--backup', choices=['file', 'archive', 'none'], default='file', help='Backup of the notes.yaml files to write: file copies each one to notes.yaml.bk, archive stores all of them in a single notes_yaml_backup_<time>.tar.gz, none makes no backup.')
+    parser.add_argument('--backend', choices=SUMMARY_BACKENDS, default='csv', help='Read the summary from notes_summary.csv or from notes_summary.sqlite.')
+    add_preview_arguments(parser)
+    add_selection_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    selection = get_selection_from_args(args)
+    start_profiling_from_args(args)
+    try:
+        update(args, selection)
+    finally:
+        stop_profiling_from_args(args)
 
+def update(args, selection):
+    '''
+    Update the notes.yaml files selected by selection (see get_notes_dirs) from the summary, as described by the arguments of main
+    '''
     has_changes_in_all = False
     
     # Get data from CSV
-    if not os.path.exists('notes_summary.csv'):
-        print("Error: notes_summary.csv not found")
+    summary_file = get_summary_file(args.backend)
+    if not os.path.exists(summary_file):
+        print(f"Error: {summary_file} not found")
         return
     
-    csv_df = get_df_from_csv()
-    print("Loaded notes_summary.csv")
+    csv_df = get_df_from_csv(backend=args.backend)
+    print(f"Loaded {summary_file}")
     
     # Get current data from yaml files
-    folder_df = get_df_from_folders()
+    folder_df = get_df_from_folders(use_cache=not args.no_cache, jobs=args.jobs, selection=selection)
+    if selection is not None:
+        # Only the rows of the selected folders are compared
+        print(f"{len(folder_df)} folders selected, the other rows of {summary_file} are ignored")
+        csv_df = csv_df[csv_df.index.isin(folder_df.index)]
     
     # Compare the dataframes
     ids_only_in_csv, ids_only_in_folders, changed_value_in_csv_id_column, changed_value_in_folders_id_column = compare_two_df(csv_df,folder_df)
     
     if len(ids_only_in_csv) > 0:
         print(f"\nThe following ids are in the CSV but their folders are not found. These will be ignored:")
-        for i, id in enumerate(ids_only_in_csv):
-            print(f"{i+1}: {id}")
+        print_ids(ids_only_in_csv, preview=args.preview, limit=args.preview_limit)
     
     if len(ids_only_in_folders) > 0:
         print(f"\nThe following ids are in folders but not in the CSV. These will be ignored:")
-        for i, id in enumerate(ids_only_in_folders):
-            print(f"{i+1}: {id}")
+        print_ids(ids_only_in_folders, preview=args.preview, limit=args.preview_limit)
     
     if len(changed_value_in_csv_id_column) > 0:
         has_changes_in_all = True
         print("\nChanges in notes.yaml in each folder:")
-        for id in changed_value_in_csv_id_column.keys():
-            changed_value_in_csv_column = changed_value_in_csv_id_column[id]
-            changed_value_in_folder_column = changed_value_in_folders_id_column[id]
-            print(f"\nChanges in ./{id}/notes.yaml:")
-            for col in changed_value_in_csv_column.keys():
-                print(f"  {col}: {changed_value_in_folder_column[col]} -> {changed_value_in_csv_column[col]}")
+        print_changes(changed_value_in_folders_id_column, changed_value_in_csv_id_column, preview=args.preview, limit=args.preview_limit, title='Changes in ./{id}/notes.yaml:')
                 
     # Handle changes based on --write flag
     if has_changes_in_all:
         if args.write:
-            write_yaml_from_csv(changed_value_in_csv_id_column,csv_df.columns)
+            batch = new_journal_batch()
+            write_yaml_from_csv(changed_value_in_csv_id_column,csv_df.columns,jobs=args.jobs,backup=args.backup,journal_old_id_column=changed_value_in_folders_id_column,journal_batch=batch)
+            print(f"The changes are recorded as batch {batch} in {NOTES_JOURNAL_FILE}, run python undo_notes.py to revert them.")
         else:
             print("\n" + "="*80)
             print("This is a preview mode. No changes have been written to the yaml files.")
@@ -3,26 +3,89 @@ import shutil
 import numpy as np
 import glob
 import os
+import sys
+import re
+import time
+import tarfile
+import tempfile
+import sqlite3
+import json
+import csv
+import io
+import argparse
+from datetime import datetime
+from fnmatch import fnmatch
+import hashlib
+import marshal
+import itertools
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import ruamel.yaml
 from ruamel.yaml import YAML
 from ruamel.yaml.comments import CommentedMap
 import ast
 import pandas as pd
+from profiling import profile_stage, start_profiling, stop_profiling
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
 STRING_YAML_EMPTY='yaml_empty'
 STRING_YAML_NO_KEY='yaml_no_key'
-def read_notes_yaml(file_path):
+NOTES_CACHE_FILE='notes_cache.json'
+# Bump this whenever the layout of the cache or the way a row is built from notes.yaml changes
+NOTES_CACHE_VERSION=2
+NOTES_SIDECAR_FEATHER='notes_summary.feather'
+NOTES_SIDECAR_NPZ='notes_summary.npz'
+# Bump this whenever the layout of the sidecar files changes
+NOTES_SIDECAR_VERSION=1
+NOTES_SQLITE_FILE='notes_summary.sqlite'
+# Backends storing the summary, see get_df_from_csv and write_csv_from_df
+SUMMARY_BACKENDS=('csv','sqlite')
+# Journal of the cells changed by the scripts, appended at each write, see append_to_journal
+NOTES_JOURNAL_FILE='notes_journal.csv'
+JOURNAL_FIELDS=['batch','time','target','op','id','column','old','new']
+# Files changed by a batch of the journal: the notes.yaml files, or the summary in one of SUMMARY_BACKENDS
+JOURNAL_TARGETS=('yaml',)+SUMMARY_BACKENDS
+# How the changes are printed in preview, see print_changes
+PREVIEW_MODES=('full','summary','head')
+# Number of the next batch of this process, see new_journal_batch
+_journal_batch_counter=itertools.count(1)
+# Loaders shared by all calls of read_notes_yaml in this process, see get_yaml_loader
+_yaml_loaders={}
+def get_yaml_loader(fast=False):
+    '''
+    Return the YAML loader used to read notes.yaml files
+    fast=False: the round-trip loader, which keeps comments and key order, needed when the file is written back
+    fast=True: the read-only safe loader, which uses the C extension of ruamel.yaml when it is installed.
+    Both loaders follow YAML 1.2 and give the same str() of the values (None, int, float, list, ...),
+    unlike yaml.CSafeLoader of PyYAML, which follows YAML 1.1 (e.g. 1e-5 is a string and yes is True).
+    Timestamps are the exception, read_notes_row reads the files with timestamps with the round-trip loader.
+    This is checked by python benchmark.py conformance.
+    '''
+    if fast not in _yaml_loaders:
+        _yaml_loaders[fast] = YAML(typ='safe') if fast else YAML()
+    return _yaml_loaders[fast]
+
+def read_notes_yaml(file_path,content=None,fast=False):
     '''
     read the yaml file and check the id is the same as the directory name
     assert the yaml file is not empty
     assert the id in the yaml file is the same as the directory name
     return the data in the yaml file
+    content: if given, parse this text instead of reading file_path again
+    fast: use the read-only loader, see get_yaml_loader. Only use it when the data is not written back.
     '''
-    yaml = YAML()
-    with open(file_path, 'r') as f:
-        data = yaml.load(f)
-        assert data is not None, f"The yaml file {file_path} is empty"
-        for key in data.keys():
-            if data[key] is None:
-                data[key] = STRING_YAML_EMPTY
+    yaml = get_yaml_loader(fast=fast)
+    if content is None:
+        with open(file_path, 'r') as f:
+            content = f.read()
+    data = yaml.load(content)
+    assert data is not None, f"The yaml file {file_path} is empty"
+    for key in data.keys():
+        if data[key] is None:
+            data[key] = STRING_YAML_EMPTY
     foldername=os.path.basename(os.path.dirname(file_path))
     assert data['id'] == foldername, f"The id {data['id']} in the yaml file {file_path} is not the same as the directory name {foldername}"
     return data
@@ -35,62 +98,443 @@ def normalize_value(value):
         return str([normalize_value(x) for x in value])
     return str(value).strip()
 
-def get_df_from_folders():
+def has_timestamp(value):
+    '''
+    Whether value, as loaded from notes.yaml, is or contains a datetime
+    '''
+    if isinstance(value, datetime):
+        return True
+    if isinstance(value, dict):
+        return any(has_timestamp(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(has_timestamp(item) for item in value)
+    return False
+
+def read_notes_row(yaml_file,content=None):
+    '''
+    read the notes.yaml file and return it as a row of the summary,
+    namely a dict with all keys and values converted to str
+    the file is read with the fast loader since the row is only used to collect the values,
+    unless it cannot parse the file or the file has timestamps, to get the same strings as the round-trip loader
+    '''
+    try:
+        data = read_notes_yaml(yaml_file,content=content,fast=True)
+    except ruamel.yaml.YAMLError:
+        # The C parser of the fast loader rejects some flow collections the round-trip one reads, e.g. [2024-01-02T10:00:00Z]
+        data = None
+    if data is None or any(has_timestamp(value) for value in data.values()):
+        # str() of a timestamp of the round-trip loader keeps the T of the file, the fast loader always writes a space
+        data = read_notes_yaml(yaml_file,content=content,fast=False)
+    # manually convert to str before converting to DatFrame, 
+    # this will make sure value 1 in notes.yaml is converted to "1" instead of "1.0" in DataFrame when doing collect_notes.py
+    return {str(key): str(value) for key, value in data.items()}
+
+def load_notes_cache():
+    '''
+    Load the entries of the notes_cache.json file: run_dir: {mtime_ns, size, sha1, row}
+    return an empty dict if the file does not exist, is unreadable, or was written
+    by another cache version, another ruamel.yaml version or other STRING_YAML_* values
+    '''
+    if not os.path.exists(NOTES_CACHE_FILE):
+        return {}
+    try:
+        with open(NOTES_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get('header') != _notes_cache_header():
+        return {}
+    return cache.get('entries', {})
+
+def save_notes_cache(entries):
+    '''
+    Atomically write the entries to the notes_cache.json file
+    '''
+    tmp_file = f'{NOTES_CACHE_FILE}.tmp{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump({'header': _notes_cache_header(), 'entries': entries}, f)
+    os.replace(tmp_file, NOTES_CACHE_FILE)
+
+def _notes_cache_header():
+    return {
+        'version': NOTES_CACHE_VERSION,
+        'ruamel_yaml': ruamel.yaml.__version__,
+        'string_yaml_empty': STRING_YAML_EMPTY,
+        'string_yaml_no_key': STRING_YAML_NO_KEY,
+    }
+
+def _read_notes_row_or_error(yaml_file_and_content):
+    '''
+    Worker of get_rows_from_folders: return (row, None), or (None, error message) if the file cannot be read
+    '''
+    yaml_file, content = yaml_file_and_content
+    try:
+        return read_notes_row(yaml_file, content=content), None
+    except Exception as e:
+        return None, f"{yaml_file}: {type(e).__name__}: {e}"
+
+def read_notes_rows(yaml_files_and_contents,jobs=1):
+    '''
+    Parse a list of (yaml_file, content) with read_notes_row, in a process pool of jobs workers if jobs>1.
+    The results are in the same order as the input, each being (row, None) or (None, error message)
+    '''
+    if jobs <= 1 or len(yaml_files_and_contents) <= 1:
+        return [_read_notes_row_or_error(item) for item in yaml_files_and_contents]
+    chunksize = max(1, len(yaml_files_and_contents) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_read_notes_row_or_error, yaml_files_and_contents, chunksize=chunksize))
+
+def get_rows_from_folders(dirs,use_cache=True,jobs=1,prune_cache=True):
+    '''
+    Read the notes.yaml files in dirs and return the rows in the same order,
+    directories without notes.yaml are skipped.
+    With use_cache, only the files whose size/mtime and sha1 are different from
+    notes_cache.json are parsed again, and the cache is updated afterwards.
+    prune_cache: if True, the entries of the directories not in dirs are removed from the cache,
+    set it to False when dirs is only a selection of the directories
+    jobs: number of processes used to parse the files
+    Errors of all files are collected and reported together in one AssertionError
+    '''
+    with profile_stage('load cache'):
+        cache_entries = load_notes_cache() if use_cache else {}
+    # run_dir: entry, the rows of the entries in to_parse are filled in after the parsing
+    new_cache_entries = {}
+    to_parse = []
+    with profile_stage('stat and read notes.yaml', len(dirs)):
+        for run_dir in dirs:
+            yaml_file = os.path.join(run_dir, 'notes.yaml')
+            try:
+                stat = os.stat(yaml_file)
+            except FileNotFoundError:
+                continue
+            entry = cache_entries.get(run_dir)
+            if entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+                with open(yaml_file, 'rb') as f:
+                    content = f.read()
+                sha1 = hashlib.sha1(content).hexdigest()
+                if entry is None or entry['sha1'] != sha1:
+                    entry = {'sha1': sha1, 'row': None}
+                    to_parse.append((run_dir, yaml_file, content.decode()))
+                entry = {**entry, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+            new_cache_entries[run_dir] = entry
+    errors = []
+    with profile_stage('parse notes.yaml', len(to_parse)):
+        results = read_notes_rows([(yaml_file, content) for _, yaml_file, content in to_parse], jobs=jobs)
+    for (run_dir, _, _), (row, error) in zip(to_parse, results):
+        if error is not None:
+            errors.append(error)
+            new_cache_entries.pop(run_dir)
+        else:
+            new_cache_entries[run_dir]['row'] = row
+    rows = [dict(entry['row']) for entry in new_cache_entries.values()]
+    if not prune_cache:
+        new_cache_entries = {**{run_dir: entry for run_dir, entry in cache_entries.items() if run_dir not in new_cache_entries}, **new_cache_entries}
+    if use_cache and new_cache_entries != cache_entries:
+        with profile_stage('save cache'):
+            save_notes_cache(new_cache_entries)
+    assert len(errors) == 0, f"{len(errors)} notes.yaml file(s) cannot be read:\n" + "\n".join(errors)
+    return rows
+
+def get_notes_dirs(ids=None,match=None,since=None,templates=None):
+    '''
+    Get the run and template directories, in the order of the rows of get_df_from_folders
+    They can be restricted by the following selectors, a directory must satisfy all the given ones:
+    ids: list of ids (e.g. 'template') and inclusive ranges of run indices (e.g. 'run1200-run1400' or '1200-1400'), see parse_id_selection
+    match: list of globs of the ids (e.g. 'run12*')
+    since: only the directories whose notes.yaml was modified at or after this time (seconds since the epoch)
+    templates: None selects the template directories with the other selectors as the runs,
+    True always selects all of them, False never selects them
+    Only the names of the directories are listed, and with since the notes.yaml files are stat'ed, none of them is opened
+    '''
+    run_dirs = sorted(glob.glob('run[0-9]*'))
+    template_dirs = sorted(glob.glob('template*'))
+    if ids is None and match is None and since is None and templates is None:
+        return run_dirs+template_dirs
+    id_selection = parse_id_selection(ids) if ids is not None else None
+
+    def is_selected(run_dir):
+        if id_selection is not None and not is_id_selected(run_dir, id_selection):
+            return False
+        if match is not None and not any(fnmatch(run_dir, pattern) for pattern in match):
+            return False
+        if since is not None:
+            try:
+                return os.stat(os.path.join(run_dir, 'notes.yaml')).st_mtime >= since
+            except (FileNotFoundError, NotADirectoryError):
+                return False
+        return True
+
+    if templates is not None:
+        template_dirs = template_dirs if templates else []
+    else:
+        template_dirs = [template_dir for template_dir in template_dirs if is_selected(template_dir)]
+    return [run_dir for run_dir in run_dirs if is_selected(run_dir)]+template_dirs
+
+def parse_id_selection(ids):
+    '''
+    Parse the ids given to get_notes_dirs, each item can hold several ones separated by commas,
+    return the set of single ids and the list of ranges of run indices (start, stop), both inclusive
+    '''
+    single_ids = set()
+    ranges = []
+    for item in ids:
+        for part in item.split(','):
+            part = part.strip()
+            if part == '':
+                continue
+            range_match = re.fullmatch(r'(?:run)?(\d+)-(?:run)?(\d+)', part)
+            if range_match:
+                start, stop = int(range_match.group(1)), int(range_match.group(2))
+                assert start <= stop, f"The range {part} is empty"
+                ranges.append((start, stop))
+            else:
+                single_ids.add(part)
+    return single_ids, ranges
+
+def is_id_selected(id, id_selection):
+    '''
+    Check whether id is in the id_selection returned by parse_id_selection
+    '''
+    single_ids, ranges = id_selection
+    if id in single_ids:
+        return True
+    index_match = re.fullmatch(r'run(\d+)', id)
+    return index_match is not None and any(start <= int(index_match.group(1)) <= stop for start, stop in ranges)
+
+def parse_since(value):
+    '''
+    Parse the time given to --since: seconds since the epoch, or an ISO 8601 date or time in local time (e.g. 2024-05-01 or 2024-05-01T14:30)
+    return the seconds since the epoch
+    '''
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {value}, expected seconds since the epoch or an ISO 8601 date or time")
+
+def add_selection_arguments(parser):
+    '''
+    Add the arguments selecting the directories (--ids, --match, --since, --templates/--no-templates) to the parser,
+    their values are given to get_notes_dirs by get_selection_from_args
+    '''
+    parser.add_argument('--ids', nargs='+', default=None, help='Only use these ids and inclusive ranges of run indices, e.g. --ids run1200-run1400 run7,template. Other directories are not read.')
+    parser.add_argument('--match', nargs='+', default=None, help="Only use the ids matching one of these globs, e.g. --match 'run12*'. Other directories are not read.")
+    parser.add_argument('--since', type=parse_since, default=None, help='Only use the directories whose notes.yaml was modified at or after this time, in seconds since the epoch or as an ISO 8601 date or time in local time, e.g. 2024-05-01T14:30. Other directories are not read.')
+    parser.add_argument('--templates', action=argparse.BooleanOptionalAction, default=None, help='Always use (--templates) or never use (--no-templates) the template directories. By default they are selected by the other options like the runs.')
+
+def get_selection_from_args(args):
+    '''
+    Get the keyword arguments of get_notes_dirs from the arguments added by add_selection_arguments,
+    return None if no directory selection is given
+    '''
+    selection = {'ids': args.ids, 'match': args.match, 'since': args.since, 'templates': args.templates}
+    if all(value is None for value in selection.values()):
+        return None
+    return selection
+
+def get_df_from_folders(use_cache=True,jobs=1,dirs=None,selection=None):
     '''
     Get the df from the notes.yaml files in the run and template directories,
     the index of the df will be set to be the id column
     id is checked to be the same as the directory name,
     the yaml file is checked to be not empty
+    use_cache: reuse the rows in notes_cache.json for notes.yaml files that have not changed
+    jobs: number of processes used to parse the notes.yaml files, the order of the rows does not depend on it
+    dirs: only read these directories instead of all the ones of get_notes_dirs
+    selection: keyword arguments of get_notes_dirs (ids, match, since, templates) to only read the selected directories
     '''
-    # Find all run directories and template directories
-    run_dirs = sorted(glob.glob('run[0-9]*'))
-    template_dirs = sorted(glob.glob('template*'))
-    # List to store all data
-    all_data = []
-    # Process each run directory
-    for run_dir in run_dirs+template_dirs:
-        yaml_file = os.path.join(run_dir, 'notes.yaml')
-        if os.path.exists(yaml_file):
-            data = read_notes_yaml(yaml_file)
-            for key in data.keys(): 
-            # manually convert to str before converting to DatFrame, 
-            # this will make sure value 1 in notes.yaml is converted to "1" instead of "1.0" in DataFrame when doing collect_notes.py
-                data[key] = str(data[key])
-            all_data.append(data)
+    is_partial = dirs is not None or selection is not None
+    if dirs is None:
+        with profile_stage('list directories'):
+            dirs = get_notes_dirs(**(selection or {}))
+    return get_df_from_rows(get_rows_from_folders(dirs,use_cache=use_cache,jobs=jobs,prune_cache=not is_partial))
+
+def get_df_from_rows(rows):
+    '''
+    Get the df from the rows of get_rows_from_folders, as returned by get_df_from_folders
+    '''
+    if len(rows) == 0:
+        return create_empty_df()
     
     # Create DataFrame
-    new_df = pd.DataFrame(all_data).fillna(value=STRING_YAML_NO_KEY)
-    # Set 'id' as the index but keep it as a column as well
-    new_df = new_df.set_index('id', drop=False)
+    with profile_stage('build DataFrame', len(rows)):
+        new_df = pd.DataFrame(rows).fillna(value=STRING_YAML_NO_KEY)
+        # Set 'id' as the index but keep it as a column as well
+        new_df = new_df.set_index('id', drop=False)
     # Convert all columns to string type and strip whitespace
-    for column in new_df.columns:
-        new_df[column] = new_df[column].astype('string').str.strip()
+    with profile_stage('normalize strings', len(rows)):
+        for column in new_df.columns:
+            new_df[column] = new_df[column].astype('string').str.strip()
     return new_df
 
-def get_df_from_csv(convert_str_to_objects=False):
+def get_summary_file(backend='csv'):
+    '''
+    Get the file storing the summary in the backend
+    '''
+    assert backend in SUMMARY_BACKENDS, f"Unknown backend {backend}"
+    return NOTES_SQLITE_FILE if backend == 'sqlite' else 'notes_summary.csv'
+
+def get_df_from_csv(convert_str_to_objects=False,use_sidecar=True,backend='csv'):
     '''
     Get the df from the notes_summary.csv file,
     the index of the df will be set to be the id column
     convert_str_to_objects: if True, convert the string values to objects 
+    use_sidecar: if True, load the df from the sidecar file written by write_csv_from_df when it is
+    up to date with notes_summary.csv, see read_notes_sidecar
+    backend: 'sqlite' to get the df from notes_summary.sqlite instead, see get_df_from_sqlite
     '''
+    if backend == 'sqlite':
+        if not os.path.exists(get_summary_file(backend)):
+            return None
+        with profile_stage('read sqlite'):
+            existing_df = get_df_from_sqlite()
+        return convert_df_str_to_objects(existing_df) if convert_str_to_objects else existing_df
     if os.path.exists('notes_summary.csv'):
-        existing_df = pd.read_csv('notes_summary.csv',dtype=str).fillna(value=STRING_YAML_NO_KEY)
-        existing_df = existing_df.set_index('id', drop=False)
-        # Convert all columns to string type and strip whitespace
-        for column in existing_df.columns:
-            existing_df[column] = existing_df[column].astype('string').str.strip()
+        with profile_stage('read sidecar'):
+            existing_df = read_notes_sidecar() if use_sidecar else None
+        if existing_df is None:
+            with profile_stage('read csv'):
+                existing_df = _read_notes_csv()
         if convert_str_to_objects:
-            existing_df=existing_df.copy().astype('object')
-            for column in existing_df.columns:
-                for index,row in existing_df.iterrows():
-                    try:
-                        existing_df.loc[[index],column]=pd.Series([ast.literal_eval(existing_df.loc[index,column])],index=[index])
-                    except:
-                        pass
+            existing_df=convert_df_str_to_objects(existing_df)
         return existing_df
     else:
         return None
 
+def _read_notes_csv():
+    return _normalize_csv_df(pd.read_csv('notes_summary.csv',dtype=str))
+
+def _normalize_csv_df(existing_df):
+    existing_df = existing_df.fillna(value=STRING_YAML_NO_KEY)
+    existing_df = existing_df.set_index('id', drop=False)
+    # Convert all columns to string type and strip whitespace
+    for column in existing_df.columns:
+        existing_df[column] = existing_df[column].astype('string').str.strip()
+    return existing_df
+
+def _notes_sidecar_metadata():
+    '''
+    The metadata a sidecar file must have to be used instead of notes_summary.csv,
+    the size and mtime of notes_summary.csv when the sidecar was written detect any later edit of the csv
+    '''
+    stat = os.stat('notes_summary.csv')
+    return {
+        'version': NOTES_SIDECAR_VERSION,
+        'csv_mtime_ns': stat.st_mtime_ns,
+        'csv_size': stat.st_size,
+        'string_yaml_no_key': STRING_YAML_NO_KEY,
+    }
+
+def write_notes_sidecar(df):
+    '''
+    Write df, as returned by get_df_from_csv(use_sidecar=False), to a columnar sidecar file next to notes_summary.csv:
+    notes_summary.feather (uncompressed, can be memory-mapped) if pyarrow is installed, notes_summary.npz otherwise.
+    It has to be called after notes_summary.csv is written since the sidecar records its size and mtime.
+    '''
+    metadata = json.dumps(_notes_sidecar_metadata())
+    df = df.reset_index(drop=True)
+    if pyarrow is not None:
+        sidecar_file = NOTES_SIDECAR_FEATHER
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'exptree': metadata.encode()})
+        tmp_file = f'{sidecar_file}.tmp{os.getpid()}'
+        pyarrow.feather.write_feather(table, tmp_file, compression='uncompressed')
+    else:
+        sidecar_file = NOTES_SIDECAR_NPZ
+        tmp_file = f'{sidecar_file}.tmp{os.getpid()}'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, metadata=np.array(metadata), columns=np.array(df.columns, dtype=str), values=df.to_numpy(dtype=str))
+    os.replace(tmp_file, sidecar_file)
+    print(f"Sidecar saved to {sidecar_file}")
+
+def read_notes_sidecar():
+    '''
+    Load the df from notes_summary.feather or notes_summary.npz,
+    return None if there is no sidecar file written for the current notes_summary.csv,
+    e.g. the csv was edited by hand after the sidecar was written.
+    '''
+    expected_metadata = _notes_sidecar_metadata()
+    df = None
+    if pyarrow is not None and os.path.exists(NOTES_SIDECAR_FEATHER):
+        table = pyarrow.feather.read_table(NOTES_SIDECAR_FEATHER, memory_map=True)
+        metadata = (table.schema.metadata or {}).get(b'exptree')
+        if metadata is not None and json.loads(metadata) == expected_metadata:
+            df = table.to_pandas(types_mapper=lambda arrow_type: pd.StringDtype() if pyarrow.types.is_string(arrow_type) or pyarrow.types.is_large_string(arrow_type) else None)
+    if df is None and os.path.exists(NOTES_SIDECAR_NPZ):
+        with np.load(NOTES_SIDECAR_NPZ) as sidecar:
+            if json.loads(sidecar['metadata'].item()) == expected_metadata:
+                df = pd.DataFrame(sidecar['values'], columns=sidecar['columns'].tolist())
+    if df is None:
+        return None
+    for column in df.columns:
+        df[column] = df[column].astype('string')
+    return df.set_index('id', drop=False)
+
+@profile_stage('convert strings to objects')
+def convert_df_str_to_objects(df):
+    '''
+    Return a copy of df with the string values converted to objects by ast.literal_eval, column by column.
+    Values that are not python literals are kept as strings.
+    Each distinct value of a column is parsed only once, with literal_eval_cached,
+    lists, dicts, sets and tuples are copied for every cell so they can be modified independently.
+    Columns with only ints are converted to int64 and columns with only floats to float64,
+    the other columns, including those mixing ints and floats, are of object dtype, so that
+    every value is converted back to the same string.
+    '''
+    converted_df=pd.DataFrame(index=df.index)
+    for column in df.columns:
+        lookup={}
+        for value in pd.unique(df[column]):
+            parsed=literal_eval_cached(value) if isinstance(value,str) else LITERAL_EVAL_FAILED
+            lookup[value]=value if parsed is LITERAL_EVAL_FAILED else parsed
+        values=list(lookup.values())
+        if any(isinstance(value,(list,dict,set,tuple)) for value in values):
+            converted_df[column]=pd.Series([deepcopy(lookup[value]) for value in df[column]],index=df.index,dtype=object)
+            continue
+        converted=pd.Series(df[column].map(lookup).to_numpy(dtype=object),index=df.index,dtype=object)
+        if len(values)>0 and all(isinstance(value,int) and not isinstance(value,bool) for value in values):
+            try:
+                converted=converted.astype('int64')
+            except OverflowError:
+                pass
+        elif len(values)>0 and all(isinstance(value,float) for value in values):
+            converted=converted.astype('float64')
+        converted_df[column]=converted
+    return converted_df
+
+def get_ids_from_csv():
+    '''
+    Get the ids of notes_summary.csv in the order of the file, without loading the other columns
+    '''
+    ids = pd.read_csv('notes_summary.csv',dtype=str,usecols=['id'])['id']
+    return ids.fillna(value=STRING_YAML_NO_KEY).str.strip().tolist()
+
+def iter_df_from_csv_slices(stops,chunk_size):
+    '''
+    Read notes_summary.csv chunk_size rows at a time and yield the rows [0, stops[0]), [stops[0], stops[1]), ...
+    as df normalized like get_df_from_csv, then the remaining rows in df of at most chunk_size rows.
+    stops must be non-decreasing and not larger than the number of rows.
+    '''
+    chunks = (_normalize_csv_df(chunk) for chunk in pd.read_csv('notes_summary.csv',dtype=str,chunksize=chunk_size))
+    buffer = None
+    position = 0 # row number of the first row in buffer
+    for stop in stops:
+        pieces = []
+        while position < stop:
+            if buffer is None or len(buffer) == 0:
+                buffer = next(chunks)
+            n_rows = min(stop-position, len(buffer))
+            pieces.append(buffer.iloc[:n_rows])
+            buffer = buffer.iloc[n_rows:]
+            position += n_rows
+        yield pd.concat(pieces) if pieces else create_empty_df()
+    if buffer is not None and len(buffer) > 0:
+        yield buffer
+    yield from chunks
+
 def create_empty_df():
     '''
     Create an empty df with only one column, id
@@ -100,16 +544,16 @@ def create_empty_df():
     empty_df = empty_df.set_index('id', drop=False)
     return empty_df
 
-def compare_two_df(df1, df2):
+def compare_two_df_long(df1, df2):
     '''
-    Compare two df
+    Compare two df cell by cell on the whole frame at once
+    return id_only_in_df1, id_only_in_df2 and changes,
+    changes is a long-format df of the changed cells of the common ids with columns id, column, value_in_df1, value_in_df2,
+    ordered by the rows of df1 and then by the columns. Use changes.to_dict('records') for a list of records.
+    A column missing in one df is treated as STRING_YAML_NO_KEY there.
     '''
-    df1=df1.copy()
-    df2=df2.copy()
-    all_col = set(df2.columns) | set(df1.columns)
-    df1 = df1.reindex(columns=all_col,fill_value=STRING_YAML_NO_KEY)
-    df2 = df2.reindex(columns=all_col,fill_value=STRING_YAML_NO_KEY)
-
+    columns_in_df1 = set(df1.columns)
+    all_col = list(df1.columns) + [column for column in df2.columns if column not in columns_in_df1]
     
     # Find new entries
     ids_df1 = set(df1.index)
@@ -118,87 +562,166 @@ def compare_two_df(df1, df2):
     id_only_in_df1 = ids_df1 - ids_df2
     id_only_in_df2 = ids_df2 - ids_df1
     
+    common_ids = df1.index[df1.index.isin(df2.index)]
+    with profile_stage('compare', len(common_ids)):
+        df1_common = df1.reindex(index=common_ids, columns=all_col, fill_value=STRING_YAML_NO_KEY)
+        df2_common = df2.reindex(index=common_ids, columns=all_col, fill_value=STRING_YAML_NO_KEY)
+        
+        # Create a mask where values are not equal between the two dataframes, 
+        # comparisons with missing values are not counted as changes
+        comparison_mask = df1_common.ne(df2_common).to_numpy(dtype=bool, na_value=False)
+        # (row, column) positions of all the changed cells, row by row
+        rows, cols = np.nonzero(comparison_mask)
+        changes = pd.DataFrame({
+            'id': common_ids.to_numpy(dtype=object)[rows],
+            'column': np.asarray(all_col, dtype=object)[cols],
+            'value_in_df1': df1_common.to_numpy(dtype=object)[rows, cols],
+            'value_in_df2': df2_common.to_numpy(dtype=object)[rows, cols],
+        })
+    return id_only_in_df1, id_only_in_df2, changes
+
+def compare_two_df(df1, df2):
+    '''
+    Compare two df
+    return id_only_in_df1, id_only_in_df2, changed_value_in_df1_id_column, changed_value_in_df2_id_column,
+    the last two being id: column_name: value dictionaries of the changed cells, see compare_two_df_long
+    '''
+    id_only_in_df1, id_only_in_df2, changes = compare_two_df_long(df1, df2)
     changed_value_in_df1_id_column={}#id:column_name:value in df1
     changed_value_in_df2_id_column={}#id:column_name:value in df2
-    common_ids=list(ids_df1.intersection(ids_df2))
-    
-    df1_common=df1.loc[common_ids]
-    df2_common=df2.loc[common_ids]
-    
-    # Compare values for common IDs
-    # Create a mask where values are not equal between the two dataframes
-    comparison_mask = df1_common != df2_common
-    
-    # Iterate through each row (ID) where there are differences
-    for id in common_ids:
-        # Get columns where values differ for this ID
-        diff_columns = comparison_mask.loc[id][comparison_mask.loc[id] == True].index.tolist()
-        diff_values_df1 = df1_common.loc[id][diff_columns]
-        diff_values_df2 = df2_common.loc[id][diff_columns]
-        # If there are differences, add them to the changed_key dictionary
-        if diff_columns:
-            changed_value_in_df1_id_column[id] = {diff_columns[i]:diff_values_df1.iloc[i] for i in range(len(diff_columns))}
-            changed_value_in_df2_id_column[id] = {diff_columns[i]:diff_values_df2.iloc[i] for i in range(len(diff_columns))}
-    # Return the dictionary of changes (id: list of changed columns)
-
+    for id, column, value_in_df1, value_in_df2 in zip(changes['id'], changes['column'], changes['value_in_df1'], changes['value_in_df2']):
+        changed_value_in_df1_id_column.setdefault(id, {})[column] = value_in_df1
+        changed_value_in_df2_id_column.setdefault(id, {})[column] = value_in_df2
     return id_only_in_df1, id_only_in_df2, changed_value_in_df1_id_column,changed_value_in_df2_id_column
 
+# Returned by literal_eval_cached for strings that are not python literals
+LITERAL_EVAL_FAILED=object()
+# Decimal ints and floats written as python literals, ints with leading zeros like 01 are not python literals
+_DECIMAL_NUMBER_PATTERN=re.compile(r'[-+]?(?:(?P<float>(?:\d+\.\d*|\.\d+)(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)|0|[1-9]\d*)')
+@lru_cache(maxsize=65536)
+def literal_eval_cached(value):
+    '''
+    ast.literal_eval with a cache of the parsed strings,
+    return LITERAL_EVAL_FAILED instead of raising if value is not a python literal.
+    The returned objects are shared between the calls, do not modify them.
+    '''
+    # plain decimal numbers are by far the most common literals, parse them without ast
+    match = _DECIMAL_NUMBER_PATTERN.fullmatch(value)
+    if match:
+        return float(value) if match.group('float') else int(value)
+    try:
+        return ast.literal_eval(value)
+    except Exception:
+        return LITERAL_EVAL_FAILED
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _pair_numbers(object1, object2, values1, values2, int_equal):
+    '''
+    Append the numbers at the same positions of object1 and object2 to values1 and values2 as floats,
+    and to int_equal whether they are equal if both are ints (None otherwise).
+    object1 and object2 can be numbers or nested lists of numbers,
+    return False if they are not numbers, lists of different lengths, or ints too large for floats
+    '''
+    if _is_number(object1) and _is_number(object2):
+        if isinstance(object1, int) and isinstance(object2, int):
+            # ints are compared exactly, they may be too large for floats
+            values1.append(0.)
+            values2.append(0.)
+            int_equal.append(object1 == object2)
+            return True
+        try:
+            values1.append(float(object1))
+            values2.append(float(object2))
+        except OverflowError:
+            return False
+        int_equal.append(None)
+        return True
+    if isinstance(object1, list) and isinstance(object2, list) and len(object1) == len(object2):
+        return all(_pair_numbers(item1, item2, values1, values2, int_equal) for item1, item2 in zip(object1, object2))
+    return False
+
+@profile_stage('ignore float error')
 def to_ignore_float_error(changed_value_in_df1_id_column,changed_value_in_df2_id_column,abs_error=1e-15,rel_error=1e-15):
     '''
     check the id - col of two dictionaries and try to convert the string to object.
-    pop those close float numbers from both dictionaries.
-    Also pop those lists with all close float numbers .
+    pop those close numbers from both dictionaries: floats, ints compared to floats, and
+    lists or nested lists of the same structure with all numbers close.
+    Ints compared to ints are only close if they are equal.
+    The numbers of all cells are compared with a single np.isclose call,
+    and the strings are parsed with literal_eval_cached.
     Note this only works for python-float class, not for numpy-float class.
+    return two new dictionaries, the input ones are not modified
     '''
-    new_changed_value_in_df1_id_column=deepcopy(changed_value_in_df1_id_column)
-    new_changed_value_in_df2_id_column=deepcopy(changed_value_in_df2_id_column)
     assert changed_value_in_df1_id_column.keys()==changed_value_in_df2_id_column.keys(), "The keys of the two dictionaries should be the same"
+    # (id, col) of the candidate cells, and the number of pairs of numbers of each cell
+    candidate_cells=[]
+    pair_counts=[]
+    values1=[]
+    values2=[]
+    int_equal=[]
     for id in changed_value_in_df1_id_column.keys():
         assert changed_value_in_df1_id_column[id].keys()==changed_value_in_df2_id_column[id].keys(), f"The cols of id: {id} of the two dictionaries should be the same"
         for col in changed_value_in_df1_id_column[id].keys():
-            assert isinstance(changed_value_in_df1_id_column[id][col],str) and isinstance(changed_value_in_df2_id_column[id][col],str), f"The value of col: {col} of id: {id} should be a string in both dictionaries"
-            assert changed_value_in_df1_id_column[id][col]!=changed_value_in_df2_id_column[id][col], f"The value of col: {col} of id: {id} should be different in the two dictionaries"
-            try:
-                object1=ast.literal_eval(changed_value_in_df1_id_column[id][col])
-                object2=ast.literal_eval(changed_value_in_df2_id_column[id][col])
-            except:
+            value1=changed_value_in_df1_id_column[id][col]
+            value2=changed_value_in_df2_id_column[id][col]
+            assert isinstance(value1,str) and isinstance(value2,str), f"The value of col: {col} of id: {id} should be a string in both dictionaries"
+            assert value1!=value2, f"The value of col: {col} of id: {id} should be different in the two dictionaries"
+            object1=literal_eval_cached(value1)
+            object2=literal_eval_cached(value2)
+            if object1 is LITERAL_EVAL_FAILED or object2 is LITERAL_EVAL_FAILED:
                 continue
-            if isinstance(object1,float) and isinstance(object2,float):
-                if np.isclose(object1,object2,atol=abs_error,rtol=rel_error):
-                    new_changed_value_in_df1_id_column[id].pop(col)
-                    new_changed_value_in_df2_id_column[id].pop(col)
-            
-            
-            if isinstance(object1,list) and isinstance(object2,list):
-                if len(object1)==len(object2):
-                    list_length=len(object1)
-                    close_float_number=0
-                    for i in range(list_length):
-                        if isinstance(object1[i],float) and isinstance(object2[i],float) and np.isclose(object1[i],object2[i],atol=abs_error,rtol=rel_error):
-                            close_float_number+=1
-                    if close_float_number==list_length:
-                        new_changed_value_in_df1_id_column[id].pop(col)
-                        new_changed_value_in_df2_id_column[id].pop(col)
-        if len(new_changed_value_in_df1_id_column[id])==0 or len(new_changed_value_in_df2_id_column[id])==0:
-            assert len(new_changed_value_in_df1_id_column[id])==0 and len(new_changed_value_in_df2_id_column[id])==0, f"Two dictionaries should both have zero columns for id: {id} now,"
-            new_changed_value_in_df1_id_column.pop(id)
-            new_changed_value_in_df2_id_column.pop(id)
-    return new_changed_value_in_df1_id_column,new_changed_value_in_df2_id_column
+            n_pairs=len(int_equal)
+            if _pair_numbers(object1,object2,values1,values2,int_equal):
+                candidate_cells.append((id,col))
+                pair_counts.append(len(int_equal)-n_pairs)
+            else:
+                # drop the pairs appended before the structures turned out to be different
+                del values1[n_pairs:], values2[n_pairs:], int_equal[n_pairs:]
     
+    close_cells=set()
+    if candidate_cells:
+        close=np.isclose(np.array(values1),np.array(values2),atol=abs_error,rtol=rel_error)
+        is_int_pair=np.array([equal is not None for equal in int_equal],dtype=bool)
+        close[is_int_pair]=np.array([equal for equal in int_equal if equal is not None],dtype=bool)
+        pair_counts=np.array(pair_counts)
+        # a cell is close if all its pairs are close, cells without any pair (empty lists) are close
+        cell_close=np.ones(len(candidate_cells),dtype=bool)
+        has_pairs=pair_counts>0
+        if has_pairs.any():
+            starts=np.cumsum(pair_counts)-pair_counts
+            cell_close[has_pairs]=np.logical_and.reduceat(close,starts[has_pairs])
+        close_cells={cell for cell,is_close in zip(candidate_cells,cell_close) if is_close}
     
-def write_yaml_from_csv(changed_value_in_csv_id_column,column_order):
-    '''The order of the columns will be written to the yaml as in column_order'''
-    yaml = YAML()
-    yaml.preserve_quotes = True
-    yaml.indent(mapping=2, sequence=2, offset=0)
+    new_changed_value_in_df1_id_column={}
+    new_changed_value_in_df2_id_column={}
+    for id in changed_value_in_df1_id_column.keys():
+        cols=[col for col in changed_value_in_df1_id_column[id].keys() if (id,col) not in close_cells]
+        if len(cols)>0:
+            new_changed_value_in_df1_id_column[id]={col:changed_value_in_df1_id_column[id][col] for col in cols}
+            new_changed_value_in_df2_id_column[id]={col:changed_value_in_df2_id_column[id][col] for col in cols}
+    return new_changed_value_in_df1_id_column,new_changed_value_in_df2_id_column
     
-    for id in changed_value_in_csv_id_column.keys():
-        changed_value_in_csv_column = changed_value_in_csv_id_column[id]
-        yaml_file = f'{id}/notes.yaml'
-        backup_file = f'{id}/notes.yaml.bk'
+    
+def _update_yaml_file(id_changes_order_backup):
+    '''
+    Worker of write_yaml_from_csv: update {id}/notes.yaml with the changed values,
+    the file is written to a temporary file in the same directory and then atomically replaces notes.yaml
+    return (id, seconds, None), or (id, seconds, error message) if the file cannot be updated
+    '''
+    id, changed_value_in_csv_column, column_order, backup = id_changes_order_backup
+    start = time.perf_counter()
+    yaml_file = f'{id}/notes.yaml'
+    backup_file = f'{id}/notes.yaml.bk'
+    try:
+        yaml = YAML()
+        yaml.preserve_quotes = True
+        yaml.indent(mapping=2, sequence=2, offset=0)
         
         # Create backup
-        shutil.copy2(yaml_file, backup_file)
+        if backup:
+            shutil.copy2(yaml_file, backup_file)
         
         # Load existing YAML with preserved order
         with open(yaml_file, 'r') as f:
@@ -219,23 +742,407 @@ def write_yaml_from_csv(changed_value_in_csv_id_column,column_order):
                 
         # Sort the yaml data according to the column order while keeping the comments
         yaml_data = sort_yaml_keys_keep_comments(yaml_data,column_order)
-        # Write back to file
-        with open(yaml_file, 'w') as f:
-            yaml.dump(yaml_data, f)
-def write_csv_from_df(df):
+        # Write to a temporary file and replace notes.yaml with it, so notes.yaml is never half-written
+        fd, tmp_file = tempfile.mkstemp(dir=id, prefix='.notes.yaml.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                yaml.dump(yaml_data, f)
+            shutil.copymode(yaml_file, tmp_file)
+            os.replace(tmp_file, yaml_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+    except Exception as e:
+        return id, time.perf_counter()-start, f"{yaml_file}: {type(e).__name__}: {e}"
+    return id, time.perf_counter()-start, None
+
+def backup_yamls_to_archive(ids):
+    '''
+    Store {id}/notes.yaml of all ids in a single notes_yaml_backup_<time>.tar.gz file, return its name.
+    An existing archive is never overwritten, a second backup in the same second gets the name notes_yaml_backup_<time>_2.tar.gz, and so on
+    '''
+    name = f"notes_yaml_backup_{time.strftime('%Y%m%d-%H%M%S')}"
+    n = 1
+    while True:
+        archive_file = f"{name}.tar.gz" if n == 1 else f"{name}_{n}.tar.gz"
+        try:
+            archive = tarfile.open(archive_file, 'x:gz')
+            break
+        except FileExistsError:
+            n += 1
+    with archive:
+        for id in ids:
+            archive.add(f'{id}/notes.yaml')
+    return archive_file
+
+def write_yaml_from_csv(changed_value_in_csv_id_column,column_order,jobs=1,backup='file',journal_old_id_column=None,journal_batch=None):
+    '''
+    The order of the columns will be written to the yaml as in column_order
+    jobs: number of processes used to update the files
+    backup: 'file' to copy each notes.yaml to notes.yaml.bk, 'archive' to store all of them in
+    a single tar.gz file before updating any of them, see backup_yamls_to_archive, 'none' for no backup
+    journal_old_id_column: if given, the values before the change (id: column_name: value), the changes of the files
+    written are then appended to the journal as journal_batch, see append_to_journal, even if other files fail.
+    The new values are journaled as they are read back from the written files (e.g. 1.5 for 1.50), as undo_notes.py reads them
+    Each file is replaced atomically. The failures of all files are reported at the end in one AssertionError,
+    return a list of (id, seconds, error message or None)
+    '''
+    assert backup in ('file', 'archive', 'none'), f"Unknown backup mode {backup}"
+    ids = list(changed_value_in_csv_id_column.keys())
+    if backup == 'archive' and len(ids) > 0:
+        print(f"\nCreated backup: {backup_yamls_to_archive(ids)}")
+    start = time.perf_counter()
+    column_order = list(column_order)
+    tasks = [(id, changed_value_in_csv_id_column[id], column_order, backup == 'file') for id in ids]
+    with profile_stage('write notes.yaml', len(tasks)):
+        if jobs <= 1 or len(tasks) <= 1:
+            results = [_update_yaml_file(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(_update_yaml_file, tasks, chunksize=max(1, len(tasks) // (jobs * 4))))
+    failures = [error for _, _, error in results if error is not None]
+    if len(results) > 1:
+        slowest = sorted(results, key=lambda result: result[1], reverse=True)[:5]
+        print(f"\nUpdated {len(results)-len(failures)} of {len(results)} notes.yaml files in {time.perf_counter()-start:.2f} s, slowest: " + ", ".join(f"{id} {seconds*1000:.1f} ms" for id, seconds, _ in slowest))
+    if journal_old_id_column is not None:
+        written_ids = [id for id, _, error in results if error is None]
+        written_df = get_df_from_folders(use_cache=False, jobs=jobs, dirs=written_ids)
+        journal_new_id_column = {id: {column: written_df.at[id, column] if column in written_df.columns else STRING_YAML_NO_KEY for column in changed_value_in_csv_id_column[id]} for id in written_ids}
+        append_to_journal('yaml', {id: journal_old_id_column[id] for id in written_ids}, journal_new_id_column, batch=journal_batch)
+    assert len(failures) == 0, f"{len(failures)} notes.yaml file(s) cannot be updated:\n" + "\n".join(failures)
+    return results
+@profile_stage('write summary')
+def write_csv_from_df(df,sidecar=False,backend='csv',changed_value_id_column=None,backup=True):
     '''
     Write the df to the notes_summary.csv file
-    if the file exists, create a backup
+    if the file exists and backup is True, create a backup
+    the file is written to a temporary file first and then renamed, so readers never see a partially written file
     replace STRING_YAML_NO_KEY with None in the DataFrame
+    sidecar: if True, also write the columnar sidecar file read by get_df_from_csv, see write_notes_sidecar
+    backend: 'sqlite' to write the df to notes_summary.sqlite instead, see write_df_to_sqlite,
+    where only the new rows and the cells in changed_value_id_column (id: column_name: value) are written if it is given
     '''
+    if backend == 'sqlite':
+        write_df_to_sqlite(df,changed_value_id_column=changed_value_id_column)
+        print(f"Results saved to {NOTES_SQLITE_FILE}")
+        return
     df=df.copy()
-    if os.path.exists('notes_summary.csv'):
+    if backup and os.path.exists('notes_summary.csv'):
         shutil.copy2('notes_summary.csv', 'notes_summary.csv.bk')
         print("\nCreated backup: notes_summary.csv.bk")
     # Replace STRING_YAML_NO_KEY with None in the DataFrame
     df = df.replace(STRING_YAML_NO_KEY, None)
-    df.to_csv('notes_summary.csv', index=False)
+    tmp_file = f'notes_summary.csv.tmp{os.getpid()}'
+    df.to_csv(tmp_file, index=False)
+    if os.path.exists('notes_summary.csv'):
+        shutil.copymode('notes_summary.csv', tmp_file)
+    os.replace(tmp_file, 'notes_summary.csv')
+    print("Results saved to notes_summary.csv")
+    if sidecar:
+        # Store exactly what is read back from the csv
+        write_notes_sidecar(_read_notes_csv())
+def _iter_csv_records(f):
+    '''
+    Yield the records of the csv file object f as (fields, raw text of the record including its line terminator)
+    '''
+    lines = []
+    def iter_lines():
+        for line in f:
+            lines.append(line)
+            yield line
+    for fields in csv.reader(iter_lines()):
+        yield fields, ''.join(lines)
+        lines.clear()
+
+@profile_stage('write summary')
+def write_csv_rows_from_df(df,sidecar=False,backup=True):
+    '''
+    Write the rows of df to notes_summary.csv, replacing the rows with the same ids and appending the new ones,
+    while all the other rows are kept byte-for-byte.
+    The columns of df which are not in the file are appended to the header, the kept rows are then shorter than the header,
+    which is read as blank (STRING_YAML_NO_KEY) for these columns.
+    if the file exists and backup is True, create a backup, see write_csv_from_df for sidecar
+    '''
+    if not os.path.exists('notes_summary.csv'):
+        write_csv_from_df(df,sidecar=sidecar,backup=backup)
+        return
+    tmp_file = f'notes_summary.csv.tmp{os.getpid()}'
+    with open('notes_summary.csv', 'r', newline='') as f_in, open(tmp_file, 'w', newline='') as f_out:
+        records = _iter_csv_records(f_in)
+        header, header_text = next(records)
+        header = [column.strip() for column in header]
+        line_terminator = '\r\n' if header_text.endswith('\r\n') else '\n'
+        columns = header + [column for column in df.columns if column not in header]
+        # Replace STRING_YAML_NO_KEY with None in the DataFrame
+        df = df.reindex(columns=columns, fill_value=STRING_YAML_NO_KEY).replace(STRING_YAML_NO_KEY, None)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator=line_terminator)
+        def format_row(id):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(['' if pd.isna(value) else value for value in df.loc[id]])
+            return buffer.getvalue()
+        if columns != header:
+            writer.writerow(columns)
+            f_out.write(buffer.getvalue())
+        else:
+            f_out.write(header_text)
+        id_position = header.index('id')
+        written_ids = set()
+        for fields, text in records:
+            id = fields[id_position].strip() if len(fields) > id_position else None
+            if id in df.index and id not in written_ids:
+                text = format_row(id)
+                written_ids.add(id)
+            elif not text.endswith(('\n', '\r')):
+                # the last line of the file had no line terminator
+                text += line_terminator
+            f_out.write(text)
+        for id in df.index:
+            if id not in written_ids:
+                f_out.write(format_row(id))
+    shutil.copymode('notes_summary.csv', tmp_file)
+    if backup:
+        shutil.copy2('notes_summary.csv', 'notes_summary.csv.bk')
+        print("\nCreated backup: notes_summary.csv.bk")
+    os.replace(tmp_file, 'notes_summary.csv')
+    print("Results saved to notes_summary.csv")
+    if sidecar:
+        write_notes_sidecar(_read_notes_csv())
+
+@profile_stage('write summary')
+def write_csv_from_parts(part_files,columns,chunk_size=10000):
+    '''
+    Write the notes_summary.csv file by concatenating csv files written by df.to_csv(index=False),
+    reading them chunk_size rows at a time, so the whole summary is never in memory.
+    columns: the columns of the final file, columns missing in a part are written as blank (STRING_YAML_NO_KEY)
+    if the file exists, create a backup
+    '''
+    tmp_file = f'notes_summary.csv.tmp{os.getpid()}'
+    with open(tmp_file, 'w', newline='') as f:
+        pd.DataFrame(columns=columns).to_csv(f, index=False)
+        for part_file in part_files:
+            for chunk in pd.read_csv(part_file,dtype=str,keep_default_na=False,chunksize=chunk_size):
+                chunk = chunk.reindex(columns=columns,fill_value=STRING_YAML_NO_KEY)
+                chunk.replace(STRING_YAML_NO_KEY, None).to_csv(f, index=False, header=False)
+    if os.path.exists('notes_summary.csv'):
+        shutil.copy2('notes_summary.csv', 'notes_summary.csv.bk')
+        print("\nCreated backup: notes_summary.csv.bk")
+    os.replace(tmp_file, 'notes_summary.csv')
     print("Results saved to notes_summary.csv")
+def _connect_notes_sqlite():
+    '''
+    Open notes_summary.sqlite, creating its tables if needed. The summary is stored in long form:
+    cells (id, key, value) holds the cells that are not STRING_YAML_NO_KEY, as text,
+    rows (position, id) and columns (position, key) hold the order of the rows and columns of the df
+    '''
+    connection = sqlite3.connect(NOTES_SQLITE_FILE)
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS rows (position INTEGER NOT NULL, id TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS columns (position INTEGER NOT NULL, key TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS cells (id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (id, key)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS cells_key_value ON cells (key, value);
+    ''')
+    return connection
+
+def _sql_string(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+def create_sqlite_index(key):
+    '''
+    Index the numeric values of key in notes_summary.sqlite, so that numeric conditions on key
+    in get_df_from_sqlite do not scan all its cells. Text conditions use the index of all keys.
+    '''
+    connection = _connect_notes_sqlite()
+    with connection:
+        index_name = '"cells_real_' + str(key).replace('"', '""') + '"'
+        connection.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON cells (CAST(value AS REAL)) WHERE key = {_sql_string(key)}')
+    connection.close()
+
+def _append_positions(connection, table, name, values):
+    '''
+    Append the values not yet in table (rows or columns) after the last position
+    '''
+    existing = {value for (value,) in connection.execute(f'SELECT {name} FROM {table}')}
+    start = connection.execute(f'SELECT COALESCE(MAX(position) + 1, 0) FROM {table}').fetchone()[0]
+    new_values = [value for value in dict.fromkeys(values) if value not in existing]
+    connection.executemany(f'INSERT INTO {table} (position, {name}) VALUES (?, ?)', [(start + i, value) for i, value in enumerate(new_values)])
+
+def write_df_to_sqlite(df,changed_value_id_column=None):
+    '''
+    Write the df to notes_summary.sqlite in a single transaction.
+    If changed_value_id_column (id: column_name: value) is None, the whole summary is replaced by df.
+    Otherwise only the rows of df with new ids are inserted, and only the changed cells are upserted,
+    or deleted if their new value is STRING_YAML_NO_KEY. Columns left without any cell are removed.
+    '''
+    connection = _connect_notes_sqlite()
+    upsert = 'INSERT INTO cells (id, key, value) VALUES (?, ?, ?) ON CONFLICT (id, key) DO UPDATE SET value = excluded.value'
+    with connection:
+        if changed_value_id_column is None:
+            connection.execute('DELETE FROM cells')
+            connection.execute('DELETE FROM rows')
+            connection.execute('DELETE FROM columns')
+            new_df = df
+        else:
+            existing_ids = {id for (id,) in connection.execute('SELECT id FROM rows')}
+            new_df = df[~df.index.isin(existing_ids)]
+        # Long form of the new rows without the STRING_YAML_NO_KEY cells
+        values = new_df.to_numpy(dtype=object)
+        connection.executemany(upsert, ((id, key, str(value))
+            for id, row in zip(new_df.index, values) for key, value in zip(new_df.columns, row) if value != STRING_YAML_NO_KEY and not pd.isna(value)))
+        if changed_value_id_column is not None:
+            changed_cells = [(id, key, value) for id, changed_value_column in changed_value_id_column.items() for key, value in changed_value_column.items()]
+            connection.executemany('DELETE FROM cells WHERE id = ? AND key = ?', [(id, key) for id, key, value in changed_cells if value == STRING_YAML_NO_KEY])
+            connection.executemany(upsert, [(id, key, str(value)) for id, key, value in changed_cells if value != STRING_YAML_NO_KEY])
+        _append_positions(connection, 'rows', 'id', df.index)
+        _append_positions(connection, 'columns', 'key', df.columns)
+        connection.execute('DELETE FROM columns WHERE key NOT IN (SELECT DISTINCT key FROM cells)')
+    connection.close()
+
+# Operators allowed in the conditions of get_df_from_sqlite
+SQLITE_CONDITION_OPERATORS={'==': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+def get_df_from_sqlite(conditions=None):
+    '''
+    Get the df from notes_summary.sqlite, in the same form as get_df_from_csv.
+    conditions: list of (key, operator, value), e.g. [('group', '==', 'X'), ('a', '>', 0.5)],
+    only the rows matching all of them are loaded. Operators are ==, !=, <, <=, >, >=.
+    Numbers are compared numerically with the cells that look like numbers, other values as text.
+    Rows without the key never match.
+    '''
+    connection = _connect_notes_sqlite()
+    where = []
+    parameters = []
+    for key, operator, value in conditions or []:
+        assert operator in SQLITE_CONDITION_OPERATORS, f"Unknown operator {operator}, should be one of {list(SQLITE_CONDITION_OPERATORS)}"
+        # the key is written in the query so that the index of create_sqlite_index can be used
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            # text which does not start like a number, e.g. yaml_empty, would be cast to 0
+            where.append(f"id IN (SELECT id FROM cells WHERE key = {_sql_string(key)} AND CAST(value AS REAL) {SQLITE_CONDITION_OPERATORS[operator]} ? AND value GLOB '[-+.0-9]*')")
+        else:
+            where.append(f'id IN (SELECT id FROM cells WHERE key = {_sql_string(key)} AND value {SQLITE_CONDITION_OPERATORS[operator]} ?)')
+        parameters.append(value if isinstance(value, (int, float)) and not isinstance(value, bool) else str(value))
+    selected_rows = 'SELECT id, position FROM rows' + (' WHERE ' + ' AND '.join(where) if where else '')
+    ids = [id for (id,) in connection.execute(f'SELECT id FROM ({selected_rows}) ORDER BY position', parameters)]
+    columns = [key for (key,) in connection.execute('SELECT key FROM columns ORDER BY position')]
+    cells = pd.read_sql_query(f'SELECT cells.id, cells.key, cells.value FROM cells JOIN ({selected_rows}) AS selected ON cells.id = selected.id', connection, params=parameters)
+    connection.close()
+    df = cells.pivot(index='id', columns='key', values='value').reindex(index=ids, columns=columns).fillna(STRING_YAML_NO_KEY)
+    df.columns.name = None
+    df['id'] = df.index
+    for column in df.columns:
+        df[column] = df[column].astype('string')
+    return df
+
+def export_sqlite_to_csv():
+    '''
+    Write notes_summary.sqlite to notes_summary.csv, so it can be edited by hand and used by update_notes.py
+    '''
+    write_csv_from_df(get_df_from_sqlite())
+
+def new_journal_batch():
+    '''
+    Get a new batch name for append_to_journal, from the current time, the process id and a counter of the batches of this process,
+    so that several writes of one process in the same second (e.g. watch_notes.py) get different batches
+    '''
+    return f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(_journal_batch_counter)}"
+
+def append_to_journal(target,changed_value_old_id_column,changed_value_new_id_column,new_ids=(),removed_ids=(),batch=None):
+    '''
+    Append the changes written to target (see JOURNAL_TARGETS) to NOTES_JOURNAL_FILE, one record per changed cell (op 'change'),
+    added row (op 'add') and removed row (op 'remove'), all with the same batch and time, and return the batch.
+    changed_value_old_id_column and changed_value_new_id_column: id: column_name: value before and after the change
+    batch: name of the batch, a new one by default, give the same batch to journal one write in several calls
+    '''
+    if batch is None:
+        batch = new_journal_batch()
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    records = []
+    for id, changed_value_old_column in changed_value_old_id_column.items():
+        changed_value_new_column = changed_value_new_id_column[id]
+        for column, old in changed_value_old_column.items():
+            records.append([batch, now, target, 'change', id, column, old, changed_value_new_column[column]])
+    records.extend([batch, now, target, 'add', id, '', '', ''] for id in new_ids)
+    records.extend([batch, now, target, 'remove', id, '', '', ''] for id in removed_ids)
+    if len(records) == 0:
+        return batch
+    is_new_file = not os.path.exists(NOTES_JOURNAL_FILE)
+    with open(NOTES_JOURNAL_FILE, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if is_new_file:
+            writer.writerow(JOURNAL_FIELDS)
+        writer.writerows(records)
+    return batch
+
+def read_journal():
+    '''
+    Read the records of NOTES_JOURNAL_FILE as dicts with the keys JOURNAL_FIELDS, in the order they were written
+    '''
+    if not os.path.exists(NOTES_JOURNAL_FILE):
+        return []
+    with open(NOTES_JOURNAL_FILE, 'r', newline='') as f:
+        return list(csv.DictReader(f))
+
+def add_preview_arguments(parser):
+    '''
+    Add the --preview and --preview_limit arguments of print_changes and print_ids to the parser
+    '''
+    parser.add_argument('--preview', choices=PREVIEW_MODES, default='full', help='How the changes are printed: full prints every changed cell, head the changed cells of the first --preview_limit ids, summary the number of changed cells per column.')
+    parser.add_argument('--preview_limit', type=int, default=20, help='Number of ids printed with --preview head and summary.')
+
+def print_ids(ids,preview='full',limit=20,start=0):
+    '''
+    Print the numbered ids, only the first limit ones unless preview is 'full', in a single write
+    '''
+    ids = list(ids)
+    shown = ids if preview == 'full' else ids[:limit]
+    lines = [f"{start+i+1}: {id}" for i, id in enumerate(shown)]
+    if len(shown) < len(ids):
+        lines.append(f"... and {len(ids)-len(shown)} more")
+    sys.stdout.write(''.join(line + '\n' for line in lines))
+
+def count_changes_by_column(changed_value_old_id_column,changed_value_new_id_column,counts=None):
+    '''
+    Count the changed cells of each column, adding to counts (column: [number of cells, example (id, old, new)]) if given, and return counts
+    '''
+    counts = {} if counts is None else counts
+    for id, changed_value_old_column in changed_value_old_id_column.items():
+        for column, old in changed_value_old_column.items():
+            count = counts.setdefault(column, [0, (id, old, changed_value_new_id_column[id][column])])
+            count[0] += 1
+    return counts
+
+def print_change_counts(counts,n_ids):
+    '''
+    Print the counts of count_changes_by_column, from the most changed column, in a single write
+    '''
+    lines = [f"{sum(count for count, _ in counts.values())} changed cells in {n_ids} ids:"]
+    for column, (count, (id, old, new)) in sorted(counts.items(), key=lambda item: -item[1][0]):
+        lines.append(f"  {column}: {count} cells, e.g. {id}: {old} -> {new}")
+    sys.stdout.write(''.join(line + '\n' for line in lines))
+
+def print_changes(changed_value_old_id_column,changed_value_new_id_column,preview='full',limit=20,title='Changes in {id}:'):
+    '''
+    Print the changed cells as column: old -> new under title for each id, in a single write instead of one print per cell.
+    preview: 'full' prints every changed cell, 'head' the changed cells of the first limit ids,
+    'summary' the number of changed cells per column, see count_changes_by_column
+    return the number of ids printed
+    '''
+    assert preview in PREVIEW_MODES, f"Unknown preview mode {preview}"
+    ids = list(changed_value_old_id_column.keys())
+    if preview == 'summary':
+        print_change_counts(count_changes_by_column(changed_value_old_id_column, changed_value_new_id_column), len(ids))
+        return 0
+    shown = ids if preview == 'full' else ids[:max(0, limit)]
+    lines = []
+    for id in shown:
+        changed_value_new_column = changed_value_new_id_column[id]
+        lines.append('\n' + title.format(id=id))
+        lines.extend(f"  {column}: {old} -> {changed_value_new_column[column]}" for column, old in changed_value_old_id_column[id].items())
+    if len(shown) < len(ids):
+        lines.append(f"\n... and {len(ids)-len(shown)} more ids, use --preview full to print all of them")
+    sys.stdout.write(''.join(line + '\n' for line in lines))
+    return len(shown)
+
 def sort_yaml_keys_keep_comments(yaml_data: CommentedMap, column_order: list) -> CommentedMap:
     # Create a new map to store the sorted data
     new_map = CommentedMap()
@@ -257,47 +1164,256 @@ def sort_yaml_keys_keep_comments(yaml_data: CommentedMap, column_order: list) ->
                 new_map.ca.items[key] = yaml_data.ca.items[key]
     
     return new_map
-def modify_yamls_by_func(func,check_template=False,write=False,ignore_float_error=False,abs_error=1e-15,rel_error=1e-15):
+def yaml_transform(reads=None,writes=None):
     """
-    The func should take a df and return a df. It should not create or delete any rows. It should not change the index or id column of the df.
-    If write is True, the function will write the changes to the yaml files. Otherwise, it will only print the changes.
+    Decorator declaring the columns a transform of modify_yamls_by_funcs reads and writes, e.g.
+    @yaml_transform(reads=['energy','natoms'],writes=['energy_per_atom'])
+    def energy_per_atom(df):
+        df['energy_per_atom']=df['energy'].astype(float)/df['natoms'].astype(int)
+        return df
+    reads: the transform gets the id column and only these columns (the ones which are not in any notes.yaml are left out),
+    instead of a copy of the whole df.
+    writes: only these columns of the returned df are taken, the other ones are left unchanged. Columns which are not in the df are added.
+    If only reads is given, all the columns returned besides id are taken.
+    A transform without declaration gets the whole df and the returned df replaces it, as the func of modify_yamls_by_func.
+    """
+    def decorator(func):
+        func.yaml_transform_reads=None if reads is None else list(reads)
+        func.yaml_transform_writes=None if writes is None else list(writes)
+        return func
+    return decorator
+
+# Bump this whenever the layout of the extract cache files changes
+EXTRACT_CACHE_VERSION=1
+def get_extract_cache_file(extractor):
     """
-    df_old = get_df_from_folders()
+    Get the cache file of the extractor for run_extractor, one per extractor function
+    """
+    return f'extract_cache_{extractor.__name__}.json'
+
+def _extract_cache_header(extractor,outputs,hash_outputs):
+    return {
+        'version': EXTRACT_CACHE_VERSION,
+        'extractor': f'{extractor.__module__}.{extractor.__qualname__}',
+        # the cache is discarded when the code of the extractor changes
+        'code': hashlib.sha1(marshal.dumps(extractor.__code__)).hexdigest(),
+        'outputs': list(outputs),
+        'hash_outputs': hash_outputs,
+        'string_yaml_empty': STRING_YAML_EMPTY,
+    }
+
+def _get_output_files_key(run_dir,outputs,hash_outputs):
+    """
+    Get the size and mtime (and sha1 if hash_outputs) of the files of run_dir matching the globs in outputs, by path relative to run_dir
+    """
+    key={}
+    for pattern in outputs:
+        for file in sorted(glob.glob(os.path.join(run_dir,pattern))):
+            if not os.path.isfile(file):
+                continue
+            stat=os.stat(file)
+            key[os.path.relpath(file,run_dir)]=[stat.st_mtime_ns,stat.st_size]
+            if hash_outputs:
+                with open(file,'rb') as f:
+                    key[os.path.relpath(file,run_dir)].append(hashlib.sha1(f.read()).hexdigest())
+    return key
+
+def _run_extractor_or_error(extractor_run_dir_row):
+    """
+    Worker of extract_from_runs: return (values converted to str like read_notes_row, None), or (None, error message)
+    """
+    extractor, run_dir, row = extractor_run_dir_row
+    try:
+        values = extractor(run_dir, row)
+        assert isinstance(values, dict), f"The extractor returned {type(values).__name__} instead of a dict"
+        return {str(key): STRING_YAML_EMPTY if value is None else str(value) for key, value in values.items()}, None
+    except Exception as e:
+        return None, f"{run_dir}: {type(e).__name__}: {e}"
+
+def extract_from_runs(extractor,df,outputs=(),jobs=1,use_cache=True,hash_outputs=False,columns=None):
+    """
+    Call extractor(run_dir, row) for each row of df, in a process pool of jobs workers if jobs>1,
+    where run_dir is the id and row is the dict of the values of the row (only of columns if given),
+    and return the returned values as a df with the index of df.
+    The values are converted to str like the values of notes.yaml (None to STRING_YAML_EMPTY),
+    and a value not returned for a run is STRING_YAML_NO_KEY.
+    The extractor must be a function defined at the top level of a module, so it can be sent to the workers.
+    outputs: globs of the files read by the extractor, relative to the run directory, e.g. ['OUTCAR', 'results/*.json']
+    use_cache: the values are stored in the file of get_extract_cache_file together with the size and modification time of the output files
+    (and their sha1 if hash_outputs) and the row. The extractor is only called again for a run when they changed, or when the code of the extractor changed.
+    Errors of all runs are collected and reported together in one AssertionError
+    """
+    cache_file=get_extract_cache_file(extractor)
+    header=_extract_cache_header(extractor,outputs,hash_outputs)
+    cache_entries={}
+    if use_cache and os.path.exists(cache_file):
+        try:
+            with open(cache_file,'r') as f:
+                cache=json.load(f)
+            if cache.get('header') == header:
+                cache_entries=cache.get('entries',{})
+        except (OSError, ValueError):
+            pass
+    new_cache_entries={}
+    to_extract=[]
+    with profile_stage('stat output files', len(df)):
+        row_df=df if columns is None else df[[column for column in columns if column in df.columns]]
+        for id, row in zip(row_df.index, row_df.to_dict('records')):
+            row={str(key): value for key, value in row.items()}
+            files=_get_output_files_key(id,outputs,hash_outputs)
+            entry=cache_entries.get(id)
+            if entry is None or entry['files'] != files or entry['row'] != row:
+                to_extract.append((extractor,id,row))
+                entry={'files': files, 'row': row, 'values': None}
+            new_cache_entries[id]=entry
+    with profile_stage(f'extract {extractor.__name__}', len(to_extract)):
+        if jobs <= 1 or len(to_extract) <= 1:
+            results=[_run_extractor_or_error(task) for task in to_extract]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results=list(executor.map(_run_extractor_or_error, to_extract, chunksize=max(1, len(to_extract) // (jobs * 4))))
+    errors=[]
+    for (_, id, _), (values, error) in zip(to_extract, results):
+        if error is not None:
+            errors.append(error)
+            new_cache_entries.pop(id)
+        else:
+            new_cache_entries[id]['values']=values
+    if use_cache:
+        # keep the entries of the runs not in df
+        new_cache_entries={**{id: entry for id, entry in cache_entries.items() if id not in new_cache_entries}, **new_cache_entries}
+        if new_cache_entries != cache_entries:
+            tmp_file=f'{cache_file}.tmp{os.getpid()}'
+            with open(tmp_file,'w') as f:
+                json.dump({'header': header, 'entries': new_cache_entries}, f)
+            os.replace(tmp_file,cache_file)
+    assert len(errors) == 0, f"{len(errors)} run(s) cannot be extracted by {extractor.__name__}:\n" + "\n".join(errors)
+    values=[new_cache_entries[id]['values'] for id in df.index]
+    if len(values) == 0:
+        return pd.DataFrame(index=df.index)
+    return pd.DataFrame(values,index=df.index).fillna(value=STRING_YAML_NO_KEY)
+
+def run_extractor(extractor,outputs=(),reads=None,writes=None,jobs=1,use_cache=True,hash_outputs=False):
+    """
+    Return a transform for modify_yamls_by_funcs, which sets in the df the values returned by extractor(run_dir, row) for each run, see extract_from_runs, e.g.
+    def read_energy(run_dir, row):
+        with open(os.path.join(run_dir, 'OUTCAR')) as f:
+            return {'energy': parse_energy(f)}
+    modify_yamls_by_funcs([run_extractor(read_energy, outputs=['OUTCAR'], reads=['id'], writes=['energy'], jobs=8)], write=True)
+    reads: the columns of the row given to the extractor, all of them if None.
+    Since the row is part of the cache key, give only the columns the extractor needs.
+    writes: the columns taken from the returned values, all of them if None, see yaml_transform.
+    A value not returned for a run keeps its current value in notes.yaml.
+    """
+    transform_reads=None if reads is None else list(reads)+list(writes or [])
+    @yaml_transform(reads=transform_reads,writes=writes)
+    def transform(df):
+        extracted_df=extract_from_runs(extractor,df,outputs=outputs,jobs=jobs,use_cache=use_cache,hash_outputs=hash_outputs,columns=reads)
+        columns=writes if writes is not None else [column for column in extracted_df.columns if column != 'id']
+        df=df.copy()
+        for column in columns:
+            values=extracted_df[column] if column in extracted_df.columns else pd.Series(STRING_YAML_NO_KEY,index=df.index,dtype=object)
+            if column in df.columns:
+                values=values.astype(object).where(values != STRING_YAML_NO_KEY, df[column])
+            df[column]=values
+        return df
+    transform.__name__=extractor.__name__
+    return transform
+
+def _stringify_columns(df,columns,index):
+    """
+    Return the columns of df as a df of strings with whitespace stripped, in the order of index
+    """
+    return pd.DataFrame({column: df[column].astype('string').str.strip() for column in columns},index=df.index,columns=columns).reindex(index)
+
+def modify_yamls_by_funcs(transforms,check_template=False,write=False,ignore_float_error=False,abs_error=1e-15,rel_error=1e-15,use_cache=True,jobs=1,convert_str_to_objects=False,backup='file',selection=None,profile=False,profile_json=None,profile_cprofile=None,preview='full',preview_limit=20):
+    """
+    Apply the transforms to the df of the notes.yaml files in turn, and write the changes to the yaml files once at the end.
+    The notes.yaml files are read once and the df is compared once, whatever the number of transforms.
+    Each transform should take a df and return a df. It should not create or delete any rows. It should not change the index or id column of the df.
+    Each transform gets the df as returned by the previous one, with the values converted to strings (or to objects,
+    see convert_str_to_objects), so that it gets the same df as if the transforms were run one after the other by modify_yamls_by_func.
+    Transforms decorated with yaml_transform only get and change the columns they declare, see yaml_transform.
+    preview and preview_limit: how the changes are printed, see print_changes.
+    The written changes are appended to NOTES_JOURNAL_FILE, so they can be reverted with undo_notes.py.
+    The other arguments are the same as for modify_yamls_by_func.
+    """
+    if profile or profile_json is not None or profile_cprofile is not None:
+        start_profiling(cprofile=profile_cprofile is not None)
+        try:
+            return modify_yamls_by_funcs(transforms,check_template=check_template,write=write,ignore_float_error=ignore_float_error,abs_error=abs_error,rel_error=rel_error,use_cache=use_cache,jobs=jobs,convert_str_to_objects=convert_str_to_objects,backup=backup,selection=selection,preview=preview,preview_limit=preview_limit)
+        finally:
+            stop_profiling(json_file=profile_json,cprofile_file=profile_cprofile)
     if not check_template:
-        template_index=[]
-        for index,row in df_old.iterrows():
-            if row['id'].startswith('template'):
-                template_index.append(index)
-        df_old=df_old.drop(template_index,axis=0)
+        # The template directories are not read at all
+        selection={**(selection or {}),'templates':False}
+    df_old = get_df_from_folders(use_cache=use_cache,jobs=jobs,selection=selection)
     index_in_df_old=df_old.index
-    df_modified = func(df_old.copy())
-    # For adaption with other functions, here convert all columns to string and strip whitespace
-    for column in df_modified.columns:
-        df_modified[column] = df_modified[column].astype('string').str.strip()
-    id_in_df_modified=df_modified['id']
-    assert set(df_modified.index) == set(index_in_df_old), "The index of the modified df should be the same as the old df"
-    assert set(id_in_df_modified) == set(index_in_df_old), "The id column of the modified df should be the same as the old df"
+    # df_modified holds the values as strings, df_view the values given to the transforms
+    df_modified=df_old.copy()
+    df_view=convert_df_str_to_objects(df_old) if convert_str_to_objects else df_modified
+    for transform in transforms:
+        reads=getattr(transform,'yaml_transform_reads',None)
+        writes=getattr(transform,'yaml_transform_writes',None)
+        if reads is None:
+            df_input=df_view.copy()
+        else:
+            df_input=df_view[['id']+[column for column in reads if column in df_view.columns and column!='id']].copy()
+        with profile_stage(f"func {getattr(transform,'__name__',type(transform).__name__)}", len(df_old)):
+            df_result=transform(df_input)
+        assert set(df_result.index) == set(index_in_df_old), "The index of the modified df should be the same as the old df"
+        assert set(df_result['id']) == set(index_in_df_old), "The id column of the modified df should be the same as the old df"
+        if reads is None and writes is None:
+            # The whole df is replaced
+            columns=list(df_result.columns)
+            df_modified=_stringify_columns(df_result,columns,index_in_df_old)
+            df_view=convert_df_str_to_objects(df_modified) if convert_str_to_objects else df_modified
+            continue
+        columns=writes if writes is not None else [column for column in df_result.columns if column!='id']
+        assert 'id' not in columns, "A transform cannot write the id column"
+        missing_columns=[column for column in columns if column not in df_result.columns]
+        assert len(missing_columns) == 0, f"The columns {missing_columns} declared in writes are not in the df returned by {transform}"
+        df_written=_stringify_columns(df_result,columns,index_in_df_old)
+        df_written_view=convert_df_str_to_objects(df_written) if convert_str_to_objects else df_written
+        for column in columns:
+            df_modified[column]=df_written[column]
+            if convert_str_to_objects:
+                df_view[column]=df_written_view[column]
     id_only_in_df_old, id_only_in_df_modified, changed_value_in_df_old_id_column,changed_value_in_df_modified_id_column=compare_two_df(df_old,df_modified)
     if ignore_float_error:
         changed_value_in_df_old_id_column,changed_value_in_df_modified_id_column=to_ignore_float_error(changed_value_in_df1_id_column=changed_value_in_df_old_id_column,changed_value_in_df2_id_column=changed_value_in_df_modified_id_column,abs_error=abs_error,rel_error=rel_error)
     if len(changed_value_in_df_old_id_column) > 0:
         print("\nChanges in notes.yaml in each folder:")
-        for id in changed_value_in_df_old_id_column.keys():
-            changed_value_in_df_old_column = changed_value_in_df_old_id_column[id]
-            changed_value_in_df_modified_column = changed_value_in_df_modified_id_column[id]
-            print(f"\nChanges in ./{id}/notes.yaml:")
-            for col in changed_value_in_df_old_column.keys():
-                print(f"  {col}: {changed_value_in_df_old_column[col]} -> {changed_value_in_df_modified_column[col]}")
+        print_changes(changed_value_in_df_old_id_column,changed_value_in_df_modified_id_column,preview=preview,limit=preview_limit,title='Changes in ./{id}/notes.yaml:')
     else:
         print("\n" + "="*80)
         print("No changes found in any notes.yaml of the folders. Program terminated without writing any changes to the yaml files.")
         print("="*80)
         return
     if write:
-        write_yaml_from_csv(changed_value_in_df_modified_id_column,df_modified.columns)
-        print("Yaml files have been updated.")
+        batch=new_journal_batch()
+        write_yaml_from_csv(changed_value_in_df_modified_id_column,df_modified.columns,jobs=jobs,backup=backup,journal_old_id_column=changed_value_in_df_old_id_column,journal_batch=batch)
+        print(f"Yaml files have been updated. The changes are recorded as batch {batch} in {NOTES_JOURNAL_FILE}.")
     else:
         print("\n" + "="*80)
         print("This is a preview mode. No changes have been written to the yaml files.")
         print("To apply these changes, run the command with --write flag:")
         print("="*80)
+
+def modify_yamls_by_func(func,check_template=False,write=False,ignore_float_error=False,abs_error=1e-15,rel_error=1e-15,use_cache=True,jobs=1,convert_str_to_objects=False,backup='file',selection=None,profile=False,profile_json=None,profile_cprofile=None,preview='full',preview_limit=20):
+    """
+    The func should take a df and return a df. It should not create or delete any rows. It should not change the index or id column of the df.
+    If write is True, the function will write the changes to the yaml files. Otherwise, it will only print the changes.
+    If use_cache is True, unchanged notes.yaml files are not parsed again, see get_df_from_folders.
+    jobs is the number of processes used to parse and write the notes.yaml files.
+    backup is the backup mode of the notes.yaml files, see write_yaml_from_csv.
+    If convert_str_to_objects is True, func gets the values converted by convert_df_str_to_objects instead of strings,
+    e.g. int64 and float64 columns for numeric columns.
+    selection: keyword arguments of get_notes_dirs (ids, match, since, templates) to only read and modify the selected directories.
+    If profile is True, the time and memory of each stage are printed at the end, and written to the profile_json file if given, see profiling.py.
+    profile_cprofile: also run cProfile and write its statistics to this file. profile_json and profile_cprofile imply profile.
+    preview and preview_limit: how the changes are printed, see print_changes.
+    The written changes are appended to NOTES_JOURNAL_FILE, so they can be reverted with undo_notes.py.
+    To apply several functions, use modify_yamls_by_funcs, which reads, compares and writes the notes.yaml files only once.
+    """
+    return modify_yamls_by_funcs([func],check_template=check_template,write=write,ignore_float_error=ignore_float_error,abs_error=abs_error,rel_error=rel_error,use_cache=use_cache,jobs=jobs,convert_str_to_objects=convert_str_to_objects,backup=backup,selection=selection,profile=profile,profile_json=profile_json,profile_cprofile=profile_cprofile,preview=preview,preview_limit=preview_limit)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import argparse
+from fnmatch import fnmatch
+import pandas as pd
+from utils import get_df_from_folders, get_df_from_csv, get_df_from_rows, get_notes_dirs, get_summary_file, read_notes_rows, compare_two_df, write_csv_from_df, create_empty_df, append_to_journal, STRING_YAML_NO_KEY, SUMMARY_BACKENDS
+
+# Directories whose notes.yaml is collected, the same as get_notes_dirs
+NOTES_DIR_PATTERNS = ('run[0-9]*', 'template*')
+# inotify event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+# notes.yaml written in place (close) or replaced by a rename (editors, update_notes.py)
+NOTES_FILE_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+# run and template directories created or renamed in the current directory
+NOTES_DIR_MASK = IN_CREATE | IN_MOVED_TO
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+def log(message):
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+def is_notes_dir(name):
+    return any(fnmatch(name, pattern) for pattern in NOTES_DIR_PATTERNS)
+
+class Inotify:
+    """Minimal wrapper of the inotify API of Linux through ctypes, raise OSError if it is not available"""
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # watch descriptor: directory name
+        self.dirs = {}
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        self.dirs[wd] = path
+
+    def read_events(self, timeout=None):
+        """Wait at most timeout seconds (forever if None) and return the events as (directory, mask, name)"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        buffer = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset+length].rstrip(b'\0'))
+            offset += length
+            events.append((self.dirs.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def read_rows(dirs, jobs=1):
+    '''
+    Read the notes.yaml files in dirs, return the rows and the error messages of the files that cannot be read,
+    directories without notes.yaml are skipped
+    '''
+    yaml_files_and_contents = []
+    for run_dir in dirs:
+        yaml_file = os.path.join(run_dir, 'notes.yaml')
+        try:
+            with open(yaml_file, 'r') as f:
+                yaml_files_and_contents.append((yaml_file, f.read()))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    rows = []
+    errors = []
+    for row, error in read_notes_rows(yaml_files_and_contents, jobs=jobs):
+        if error is None:
+            rows.append(row)
+        else:
+            errors.append(error)
+    return rows, errors
+
+def update_summary_rows(summary_df, rows_df):
+    '''
+    Return summary_df with the rows of rows_df replacing the ones with the same id,
+    new ids are appended and new columns are filled with STRING_YAML_NO_KEY in the other rows
+    '''
+    new_columns = [column for column in rows_df.columns if column not in summary_df.columns]
+    summary_df = summary_df.reindex(columns=list(summary_df.columns) + new_columns, fill_value=STRING_YAML_NO_KEY)
+    rows_df = rows_df.reindex(columns=summary_df.columns, fill_value=STRING_YAML_NO_KEY)
+    for column in summary_df.columns:
+        summary_df[column] = summary_df[column].astype('string')
+        rows_df[column] = rows_df[column].astype('string')
+    is_existing = rows_df.index.isin(summary_df.index)
+    summary_df.loc[rows_df.index[is_existing]] = rows_df[is_existing]
+    return pd.concat([summary_df, rows_df[~is_existing]])
+
+def sync_rows(summary_df, dirs, args, backup=False):
+    '''
+    Read the notes.yaml files in dirs, write the summary if their rows differ from summary_df and return the new summary df.
+    Files that cannot be read (e.g. while they are being written) are reported and keep their previous row.
+    '''
+    rows, errors = read_rows(dirs, jobs=args.jobs)
+    for error in errors:
+        log(f"Skipped {error}")
+    rows_df = get_df_from_rows(rows)
+    ids_only_in_summary, ids_only_in_folders, changed_value_in_summary_id_column, changed_value_in_folders_id_column = compare_two_df(summary_df[summary_df.index.isin(rows_df.index)], rows_df)
+    if len(ids_only_in_folders) == 0 and len(changed_value_in_summary_id_column) == 0:
+        return summary_df
+    summary_df = update_summary_rows(summary_df, rows_df)
+    write_csv_from_df(summary_df, sidecar=args.sidecar, backend=args.backend, changed_value_id_column=changed_value_in_folders_id_column, backup=backup)
+    append_to_journal(args.backend, changed_value_in_summary_id_column, changed_value_in_folders_id_column, new_ids=ids_only_in_folders)
+    if len(ids_only_in_folders) > 0:
+        log(f"Added {len(ids_only_in_folders)} row(s): {', '.join(ids_only_in_folders)}")
+    if len(changed_value_in_summary_id_column) > 0:
+        n_cells = sum(len(columns) for columns in changed_value_in_summary_id_column.values())
+        log(f"Updated {n_cells} cell(s) in {len(changed_value_in_summary_id_column)} row(s): {', '.join(changed_value_in_summary_id_column)}")
+    return summary_df
+
+def initial_sync(args):
+    '''
+    Collect all the notes.yaml files like collect_notes.py --write and return the summary df
+    '''
+    summary_file = get_summary_file(args.backend)
+    summary_df = get_df_from_csv(backend=args.backend) if os.path.exists(summary_file) else create_empty_df()
+    folder_df = get_df_from_folders(use_cache=not args.no_cache, jobs=args.jobs)
+    log(f"Collected {len(folder_df)} notes.yaml file(s)")
+    ids_only_in_summary, ids_only_in_folders, changed_value_in_summary_id_column, changed_value_in_folders_id_column = compare_two_df(summary_df, folder_df)
+    # Keep the ids without folders, as collect_notes.py
+    new_df = pd.concat([folder_df, summary_df[summary_df.index.isin(ids_only_in_summary)]])
+    if len(ids_only_in_folders) > 0 or len(changed_value_in_summary_id_column) > 0 or not os.path.exists(summary_file):
+        write_csv_from_df(new_df, sidecar=args.sidecar, backend=args.backend, changed_value_id_column=changed_value_in_folders_id_column)
+        append_to_journal(args.backend, changed_value_in_summary_id_column, changed_value_in_folders_id_column, new_ids=[id for id in folder_df.index if id in ids_only_in_folders])
+        log(f"Initial sync: {len(ids_only_in_folders)} new row(s), {len(changed_value_in_summary_id_column)} changed row(s)")
+    else:
+        log(f"{summary_file} is up to date")
+    return new_df
+
+def start_inotify():
+    '''
+    Watch the current directory and the run and template directories with inotify, raise OSError if inotify cannot be used
+    '''
+    inotify = Inotify()
+    try:
+        inotify.add_watch('.', NOTES_DIR_MASK)
+        for notes_dir in get_notes_dirs():
+            inotify.add_watch(notes_dir, NOTES_FILE_MASK)
+    except OSError:
+        inotify.close()
+        raise
+    log(f"Watching {len(inotify.dirs)-1} directories with inotify")
+    return inotify
+
+def watch_with_inotify(inotify, summary_df, args):
+    '''
+    Wait for the events of inotify, see start_inotify, including the ones queued during the initial sync.
+    The directories of the events are synced once no event arrived for args.debounce seconds,
+    or args.max_delay seconds after the first one at the latest
+    '''
+    pending = set()
+    first_event_time = last_event_time = None
+    while True:
+        timeout = None
+        if pending:
+            now = time.monotonic()
+            timeout = max(0, min(last_event_time + args.debounce, first_event_time + args.max_delay) - now)
+        events = inotify.read_events(timeout)
+        for watched_dir, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, check all the directories
+                pending.update(get_notes_dirs())
+            elif watched_dir == '.':
+                if mask & IN_ISDIR and is_notes_dir(name):
+                    # notes.yaml may have been written before the watch is added
+                    try:
+                        inotify.add_watch(name, NOTES_FILE_MASK)
+                    except OSError as e:
+                        # e.g. the directory was already removed or renamed
+                        log(f"Cannot watch {name} ({e})")
+                    pending.add(name)
+            elif name == 'notes.yaml':
+                pending.add(watched_dir)
+        if events and pending:
+            last_event_time = time.monotonic()
+            if first_event_time is None:
+                first_event_time = last_event_time
+        if pending and (not events or time.monotonic() - first_event_time >= args.max_delay):
+            summary_df = sync_rows(summary_df, sorted(pending), args)
+            pending.clear()
+            first_event_time = last_event_time = None
+
+def get_notes_stats():
+    '''
+    Get the size and modification time of the notes.yaml files of the run and template directories
+    '''
+    stats = {}
+    with os.scandir('.') as entries:
+        for entry in entries:
+            if is_notes_dir(entry.name) and entry.is_dir():
+                try:
+                    stat = os.stat(os.path.join(entry.name, 'notes.yaml'))
+                except FileNotFoundError:
+                    continue
+                stats[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return stats
+
+def watch_with_polling(summary_df, stats, args):
+    '''
+    Check the size and modification time of the notes.yaml files every args.interval seconds,
+    and sync the directories whose notes.yaml changed since the previous check, stats being the first one, see get_notes_stats
+    '''
+    log(f"Watching by polling every {args.interval} seconds")
+    while True:
+        new_stats = get_notes_stats()
+        changed_dirs = [notes_dir for notes_dir, stat in new_stats.items() if stats.get(notes_dir) != stat]
+        if changed_dirs:
+            summary_df = sync_rows(summary_df, sorted(changed_dirs), args)
+        stats = new_stats
+        time.sleep(args.interval)
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep notes_summary.csv in sync with the notes.yaml files, rewriting it whenever they change')
+    parser.add_argument('--debounce', type=float, default=1.0, help='Seconds without new changes to wait before updating the summary, so that a burst of writes is handled at once.')
+    parser.add_argument('--max_delay', type=float, default=10.0, help='Update the summary at most this many seconds after a change even if changes keep coming.')
+    parser.add_argument('--polling', action='store_true', help='Check the notes.yaml files every --interval seconds instead of using inotify. Used automatically when inotify cannot be started (e.g. not on Linux). Pass it on network filesystems, where inotify starts but does not see the changes made on other machines.')
+    parser.add_argument('--interval', type=float, default=2.0, help='Seconds between two checks with --polling.')
+    parser.add_argument('--no_cache', action='store_true', help='Parse every notes.yaml again in the initial scan instead of reusing the unchanged rows stored in notes_cache.json.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes used to parse the notes.yaml files.')
+    parser.add_argument('--sidecar', action='store_true', help='Also write the columnar sidecar of notes_summary.csv each time it is written, see collect_notes.py.')
+    parser.add_argument('--backend', choices=SUMMARY_BACKENDS, default='csv', help='Store the summary in notes_summary.csv or in notes_summary.sqlite, see collect_notes.py.')
+    args = parser.parse_args()
+    if args.backend == 'sqlite' and args.sidecar:
+        parser.error('--sidecar cannot be used with --backend sqlite')
+
+    # Start watching before the initial sync, so that the notes.yaml files written during it are synced afterwards
+    inotify = None
+    if not args.polling:
+        try:
+            inotify = start_inotify()
+        except OSError as e:
+            log(f"Cannot use inotify ({e}), falling back to polling")
+    if inotify is None:
+        stats = get_notes_stats()
+    try:
+        summary_df = initial_sync(args)
+        if inotify is not None:
+            watch_with_inotify(inotify, summary_df, args)
+        else:
+            watch_with_polling(summary_df, stats, args)
+    except KeyboardInterrupt:
+        log("Stopped")
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+if __name__ == "__main__":
+    main()